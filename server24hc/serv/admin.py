@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
@@ -43,17 +43,23 @@ class TeamPlayerFilter(admin.SimpleListFilter):
 
 class TeamAdmin(admin.ModelAdmin):
     list_display = ('name', 'position', 'student', 'games_played', 'score_player', 'score_game', 'score_full')
-    actions = ['recompute_score']
+    actions = ['recompute_score', 'check_score']
 
     @admin.action(description='Recompute score')
     def recompute_score(self, request, queryset):
-        for team in queryset:
-            team.score_player = team.compute_score_player()
-            team.score_game = team.compute_score_game()
-            team.save()
+        Team.update_scores(list(queryset))
+
+    @admin.action(description='Check score')
+    def check_score(self, request, queryset):
+        stale = Team.stale_scores(list(queryset))
+        for team, score_player, score_game in stale:
+            self.message_user(request, f'{team.name}: {team.score_player}/{team.score_game} saved, '
+                                       f'{score_player}/{score_game} recomputed', messages.WARNING)
+        if not stale:
+            self.message_user(request, 'Scores are up to date')
 
 class MapAdmin(admin.ModelAdmin):
-    list_display = ('id', 'proposed_by', 'size', 'in_stage', 'proposed_at', 'impossible')
+    list_display = ('id', 'proposed_by', 'size', 'in_stage', 'proposed_at', 'impossible', 'optimal_moves')
     list_filter = ('proposed_by', StagelistFilter)
 
 
@@ -1,78 +1,858 @@
 #!/usr/bin/env python
 # -*- coding:utf8 -*-
 
-import itertools
-from collections import namedtuple
+import functools
+import glob
+import gzip
+import heapq
+import json
+import math
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from array import array
+from collections import defaultdict, namedtuple
 
 from .maputils import Map
+from .solutions import SolutionStore, SolveResult
+
+class StateSpace:
+    """Packs the states of a map into integers from 0 to size-1.
+
+    Positions lie within the universe, and so does every position a move
+    ends at, so that each velocity component is smaller than the universe
+    along its axis. States are numbered in mixed radix over these ranges."""
+
+    def __init__(self, m):
+        self.Nx, self.Ny, self.Nz, self.Ncp = m.Nx, m.Ny, m.Nz, m.maxcp + 1
+        self.size = m.Nx * m.Ny * m.Nz * (2*m.Nx-1) * (2*m.Ny-1) * (2*m.Nz-1) * self.Ncp
+
+    def pack(self, state):
+        Px, Py, Pz, Vx, Vy, Vz, checkpoint = state
+        Nx, Ny, Nz = self.Nx, self.Ny, self.Nz
+        return ((((((Px * Ny + Py) * Nz + Pz) * (2*Nx-1) + Vx+Nx-1) * (2*Ny-1) + Vy+Ny-1) * (2*Nz-1) + Vz+Nz-1) * self.Ncp + checkpoint)
+
+    def unpack(self, index):
+        Nx, Ny, Nz = self.Nx, self.Ny, self.Nz
+        index, checkpoint = divmod(index, self.Ncp)
+        index, Vz = divmod(index, 2*Nz-1)
+        index, Vy = divmod(index, 2*Ny-1)
+        index, Vx = divmod(index, 2*Nx-1)
+        index, Pz = divmod(index, Nz)
+        Px, Py = divmod(index, Ny)
+        return Map.State(Px, Py, Pz, Vx-Nx+1, Vy-Ny+1, Vz-Nz+1, checkpoint)
+
+def mapped_array(filename, typecode, length, fill=0):
+    """Return a memoryview of length items of an array typecode, backed by a
+    memory-mapped file, that reads and writes like an array. The pages are
+    left to the system, to keep in memory or write back to the file."""
+    itemsize = array(typecode).itemsize
+    with open(filename, 'w+b') as f:
+        f.truncate(length * itemsize)
+        mm = mmap.mmap(f.fileno(), length * itemsize)
+    items = memoryview(mm).cast(typecode)
+    if fill:
+        chunk = array(typecode, [fill]) * min(length, 1 << 16)
+        for i in range(0, length, len(chunk)):
+            items[i:i+len(chunk)] = chunk[:length-i]
+    return items
+
+def release_array(items):
+    """Unmap an array of mapped_array, a no-op for a plain array."""
+    if isinstance(items, memoryview):
+        mm = items.obj
+        items.release()
+        mm.close()
+
+class StateTable:
+    """Moves and parent of the states reached by a search, as packed ints.
+
+    An open addressing hash table over two arrays, taking 12 bytes a slot
+    (8 for the key, 4 for the value), at most 24 bytes a state as the table
+    is kept at most half full, where a dict of State to a StateInfo
+    namedtuple takes hundreds of bytes an entry. The value of a state packs the moves to reach it, the
+    checkpoint of its parent state and the index of the acceleration from it
+    in Map.accelerations: the parent state is found back from these.
+
+    With a directory, the arrays are files of it mapped in memory (see
+    mapped_array), for tables larger than the memory."""
+
+    key_type, value_type = 'q', 'I' # Values fit in 24 bits: moves << 8 | checkpoint << 5 | acceleration
+    slot_size = array(key_type).itemsize + array(value_type).itemsize
+
+    def __init__(self, capacity=1 << 16, directory=None):
+        self.directory = directory
+        self.keys, self.values = self.allocate(capacity)
+        self.count = 0
+
+    def allocate(self, capacity):
+        if self.directory is None:
+            return array(self.key_type, [-1]) * capacity, array(self.value_type, [0]) * capacity
+        return (mapped_array(os.path.join(self.directory, f'keys.{capacity}'), self.key_type, capacity, -1),
+                mapped_array(os.path.join(self.directory, f'values.{capacity}'), self.value_type, capacity))
+
+    def release(self, keys, values):
+        """Unmap and delete the files of arrays of a table with a directory."""
+        if self.directory is not None:
+            capacity = len(keys)
+            release_array(keys)
+            release_array(values)
+            for name in ('keys', 'values'):
+                os.remove(os.path.join(self.directory, f'{name}.{capacity}'))
+
+    def close(self):
+        self.release(self.keys, self.values)
+
+    def spill(self, directory):
+        """Return a copy of the table with its arrays in files of directory."""
+        table = StateTable(len(self.keys), directory)
+        table.keys[:], table.values[:], table.count = self.keys, self.values, self.count
+        return table
+
+    def save(self, f):
+        f.write(self.keys)
+        f.write(self.values)
+
+    @classmethod
+    def load(cls, f, capacity, count, directory=None):
+        """Read back a table written by save, of that capacity and count."""
+        table = cls(capacity, directory)
+        for items in (table.keys, table.values):
+            view = memoryview(items).cast('B')
+            if f.readinto(view) != len(view): raise EOFError("truncated state table")
+        table.count = count
+        return table
+
+    @staticmethod
+    def value(moves, checkpoint, Ax, Ay, Az):
+        return moves << 8 | checkpoint << 5 | Map.accelerations.index((Ax, Ay, Az))
+
+    def slot(self, key):
+        keys, mask = self.keys, len(self.keys) - 1
+        i = (key * 0x9e3779b97f4a7c15 >> 24) & mask # Fibonacci hashing
+        while keys[i] != key and keys[i] != -1:
+            i = (i + 1) & mask
+        return i
+
+    def get(self, key):
+        i = self.slot(key)
+        return self.values[i] if self.keys[i] == key else None
+
+    def __setitem__(self, key, value):
+        i = self.slot(key)
+        if self.keys[i] == -1:
+            if 2 * (self.count + 1) > len(self.keys):
+                self.grow()
+                i = self.slot(key)
+            self.keys[i] = key
+            self.count += 1
+        self.values[i] = value
+
+    @property
+    def nbytes(self):
+        return len(self.keys) * self.slot_size
+
+    def grow(self):
+        keys, values = self.keys, self.values
+        self.keys, self.values = self.allocate(2 * len(keys))
+        for key, value in zip(keys, values):
+            if key != -1:
+                i = self.slot(key)
+                self.keys[i], self.values[i] = key, value
+        self.release(keys, values)
+
+    def path(self, space, index):
+        """Return the accelerations leading to the state of that index."""
+        path = []
+        value = self.get(index)
+        while value >> 8:
+            Ax, Ay, Az = Map.accelerations[value & 31]
+            Px, Py, Pz, Vx, Vy, Vz, checkpoint = space.unpack(index)
+            path.append((Ax, Ay, Az))
+            index = space.pack(Map.State(Px-Vx, Py-Vy, Pz-Vz, Vx-Ax, Vy-Ay, Vz-Az, (value >> 5) & 7))
+            value = self.get(index)
+        return path[::-1]
+
+class Frontier:
+    """Min-heap of the int entries of a search, each of width bytes at most.
+
+    Past limit entries in memory, the larger half of them is written to a
+    sorted run in a temporary file of directory, and runs are read back one
+    entry at a time as they come first, merged with the heap."""
+
+    def __init__(self, width, limit=None, directory=None):
+        self.width, self.limit, self.directory = width, limit, directory
+        self.heap = []
+        self.runs = [] # Heap of (first entry, run number, file) of the runs left
+        self.spilled = self.nruns = 0
+
+    def __len__(self):
+        return len(self.heap) + self.spilled
+
+    def __bool__(self):
+        return bool(self.heap) or bool(self.runs)
+
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self.heap) + sum(map(sys.getsizeof, self.heap[:1])) * len(self.heap)
+
+    def first(self):
+        if self.runs and (not self.heap or self.runs[0][0] < self.heap[0]):
+            return self.runs[0][0]
+        return self.heap[0]
+
+    def push(self, e):
+        heapq.heappush(self.heap, e)
+        if self.limit is not None and len(self.heap) > self.limit:
+            self.spill()
+
+    def pop(self):
+        if self.runs and (not self.heap or self.runs[0][0] < self.heap[0]):
+            e, n, f = heapq.heappop(self.runs)
+            self.next_of_run(n, f)
+            self.spilled -= 1
+            return e
+        return heapq.heappop(self.heap)
+
+    def next_of_run(self, n, f):
+        data = f.read(self.width)
+        if data:
+            heapq.heappush(self.runs, (int.from_bytes(data, 'big'), n, f))
+        else:
+            f.close()
+
+    def spill(self):
+        self.heap.sort() # A sorted list is a heap
+        keep = len(self.heap) // 2
+        f = tempfile.TemporaryFile(dir=self.directory)
+        f.write(b''.join(e.to_bytes(self.width, 'big') for e in self.heap[keep:]))
+        f.seek(0)
+        self.spilled += len(self.heap) - keep
+        del self.heap[keep:]
+        self.nruns += 1
+        self.next_of_run(self.nruns, f)
+
+    def save(self, f):
+        """Write every entry, in no particular order, leaving the runs as
+        they are."""
+        f.write(b''.join(e.to_bytes(self.width, 'big') for e in self.heap))
+        for e, n, run in self.runs:
+            position = run.tell()
+            f.write(e.to_bytes(self.width, 'big'))
+            while chunk := run.read(self.width << 12):
+                f.write(chunk)
+            run.seek(position)
+
+    def load(self, f, count):
+        """Push back count entries written by save."""
+        for _ in range(count):
+            data = f.read(self.width)
+            if len(data) != self.width: raise EOFError("truncated frontier")
+            self.heap.append(int.from_bytes(data, 'big'))
+            if self.limit is not None and len(self.heap) > self.limit:
+                self.spill()
+        heapq.heapify(self.heap)
+
+    def close(self):
+        for e, n, f in self.runs:
+            f.close()
+        self.runs = []
 
 def bruteforce_solve(m, stop_at_first=False, progress=False):
     if not m.valid: return [], 0
 
-    StateInfo = namedtuple('StateInfo', 'moves prevstate Ax Ay Az'.split())
-    initial_state = Map.State(m.Sx, m.Sy, m.Sz, 0, 0, 0, 0)
-    infos = { initial_state: StateInfo(0, initial_state, 0, 0, 0) }
+    space = StateSpace(m)
+    initial = space.pack(m.startstate)
+    infos = StateTable()
+    infos[initial] = 0
     toexplore = set()
-    toexplore.add(initial_state)
-    finalstateinfo = None
+    toexplore.add(initial)
+    final = None
 
     try:
         count = 0
         while toexplore:
-            state = toexplore.pop()
-            if finalstateinfo and infos[state].moves > finalstateinfo.moves: continue
+            index = toexplore.pop()
+            moves = infos.get(index) >> 8
+            if final and moves > final[0]: continue
             count += 1
             if progress:
                 if count & 0xfff == 0:
                     print(f".", file=sys.stderr, end="\n" if count & 0xffff == 0 else "")
                     sys.stderr.flush()
-            for Ax, Ay, Az in itertools.product((-1, 0, 1), (-1, 0, 1), (-1, 0, 1)):
-                result = m.analyze_path_step(state, Ax, Ay, Az)
+            state = space.unpack(index)
+            for (Ax, Ay, Az), result in m.successors(state, prune=True):
                 if isinstance(result, Map.State):
-                    if result in infos:
-                        nmoves = infos[state].moves + 1
-                        if nmoves < infos[result].moves:
-                            infos[result] = StateInfo(nmoves, state, Ax, Ay, Az)
+                    rindex = space.pack(result)
+                    value = infos.get(rindex)
+                    if value is not None:
+                        if moves + 1 < value >> 8:
+                            infos[rindex] = StateTable.value(moves + 1, state.checkpoint, Ax, Ay, Az)
 
                     else:
-                        toexplore.add(result)
-                        infos[result] = StateInfo(infos[state].moves+1, state, Ax, Ay, Az)
+                        toexplore.add(rindex)
+                        infos[rindex] = StateTable.value(moves + 1, state.checkpoint, Ax, Ay, Az)
                 else:
                     if result.ok:
-                        nmoves = infos[state].moves + result.moves
-                        accepted = not finalstateinfo or nmoves < finalstateinfo.moves
+                        nmoves = moves + result.moves
+                        accepted = not final or nmoves < final[0]
                         if progress:
                             if accepted:
                                 print(f"Found: {nmoves} moves", file=sys.stderr)
                             else:
                                 print(f"Rejected found: {nmoves} moves", file=sys.stderr)
                         if accepted:
-                            finalstateinfo = StateInfo(nmoves, state, Ax, Ay, Az)
+                            final = (nmoves, index, (Ax, Ay, Az), result.moves)
                         if stop_at_first:
                             toexplore.clear()
     except KeyboardInterrupt:
         pass
 
-    if finalstateinfo:
-        path = []
-        p = finalstateinfo
-        while p.moves != 0:
-            path = [(p.Ax, p.Ay, p.Az)] + path
-            p = infos[p.prevstate]
-        return path, finalstateinfo.moves
+    if final:
+        # States on the way may have been reached with fewer moves since
+        _, index, A, submoves = final
+        path = infos.path(space, index)
+        return path + [A], len(path) + submoves
     return [], 0
 
+def axis_targets(m, axis):
+    """Intervals, in sixths of cell, that the coordinate along axis (0 for x,
+    1 for y, 2 for z) must touch at each stage: targets[k] for the blocks of
+    checkpoint k+1 while k < maxcp, then targets[maxcp] for the goal blocks."""
+    targets = [[] for _ in range(m.maxcp + 1)]
+    for i, code in enumerate(m.grid):
+        if not code: continue
+        bt = (code >> 12) & 7
+        if bt == 0: stage = m.maxcp
+        elif bt >= 4: stage = bt - 4
+        else: continue
+        B = (i % m.Nx, i // m.Nx % m.Ny, i // (m.Nx*m.Ny))[axis]
+        extents = (code >> 4*axis) & 15
+        targets[stage].append((6*B - (extents >> 2), 6*B + (extents & 3)))
+    return [sorted(set(intervals)) for intervals in targets]
+
+def earliest_touch(P, V, intervals, t0):
+    """Return the first time from t0 to 1 at which 6*P + 6*V*t lies in one of
+    the intervals, None if it never does."""
+    first = None
+    for lo, hi in intervals:
+        if V:
+            ta, tb = sorted(((lo - 6*P) / (6*V), (hi - 6*P) / (6*V)))
+        elif lo <= 6*P <= hi:
+            ta, tb = 0, 1
+        else:
+            continue
+        t = max(ta, t0)
+        if t <= min(tb, 1) and (first is None or t < first):
+            first = t
+    return first
+
+def axis_bounds(N, targets):
+    """Fewest moves to win along one axis, from each (P, V, stage).
+
+    The axis is a one dimensional race where the coordinate stays within the
+    universe at the end of each move but the last, and must touch the
+    targets of each stage in turn. As for the real game, the last move only
+    counts up to the time the goal is touched. Costs are found with a
+    backward Dijkstra search from the victory."""
+    maxcp = len(targets) - 1
+    dist = {}
+    previous = defaultdict(list)
+    for P in range(N):
+        for V in range(-N+1, N):
+            for stage in range(maxcp + 1):
+                for A in (-1, 0, 1):
+                    nV = V + A
+                    t, nstage = 0, stage
+                    while t is not None and nstage < maxcp:
+                        t = earliest_touch(P, nV, targets[nstage], t)
+                        if t is not None: nstage += 1
+                    if t is not None:
+                        t = earliest_touch(P, nV, targets[maxcp], t)
+                        if t is not None:
+                            dist[P, V, stage] = min(t, dist.get((P, V, stage), 1))
+                            continue
+                    if 0 <= P + nV < N:
+                        previous[P + nV, nV, nstage].append((P, V, stage))
+
+    toexplore = [(d, s) for s, d in dist.items()]
+    heapq.heapify(toexplore)
+    while toexplore:
+        d, s = heapq.heappop(toexplore)
+        if d > dist[s]: continue
+        for p in previous[s]:
+            if d + 1 < dist.get(p, d + 2):
+                dist[p] = d + 1
+                heapq.heappush(toexplore, (d + 1, p))
+    return dist
+
+def kinematic_bound(m):
+    """Return an admissible estimate of the moves a state needs to win.
+
+    Blocks in the way, nebulas and magnetic clouds are ignored, so that each
+    axis can be solved on its own (see axis_bounds): a path in the map is a
+    path along each axis, so the estimate is the largest of the three. It is
+    None for states that cannot win at all."""
+    bounds = [axis_bounds(N, axis_targets(m, axis)) for axis, N in enumerate((m.Nx, m.Ny, m.Nz))]
+    def estimate(state):
+        Px, Py, Pz, Vx, Vy, Vz, checkpoint = state
+        try:
+            # Float times may be off by an ulp, keep the estimate below them
+            return max(bounds[0][Px, Vx, checkpoint], bounds[1][Py, Vy, checkpoint],
+                       bounds[2][Pz, Vz, checkpoint]) - 1e-9
+        except KeyError:
+            return None
+    return estimate
+
+def travel_moves(distance, speed):
+    """Fewest moves to travel distance cells, along the largest axis, from
+    a state at speed cells per move along its fastest axis: the speed
+    grows by one at most each move, and the last move counts up to the
+    time the distance is reached."""
+    # The n moves at full acceleration travel n*speed + n*(n+1)/2 cells
+    b = 2*speed + 1
+    n = (math.isqrt(b*b + 8*distance) - b) // 2
+    while n*speed + n*(n+1)//2 >= distance: n -= 1
+    while (n+1)*speed + (n+1)*(n+2)//2 < distance: n += 1
+    return n + (distance - n*speed - n*(n+1)//2) / (speed + n + 1)
+
+def cell_distances(m):
+    """Distances from each cell to the victory, stage by stage.
+
+    Cells are linked to their 26 neighbours unless they are filled with
+    asteroid: no move can sweep through them. fields[k][i] counts the links
+    from the cell of index i (as in m.grid) to touch the blocks of each
+    checkpoint after the k first ones, then the goal blocks, -1 if they
+    cannot be reached. It is computed from the goal back to the first
+    checkpoint, with a breadth first search per stage seeded at the blocks
+    of the next checkpoint with the distances of the stage after it."""
+    Nx, Ny, Nz, grid = m.Nx, m.Ny, m.Nz, m.grid
+    neighbours = []
+    for i, code in enumerate(grid):
+        x, y, z = i % Nx, i // Nx % Ny, i // (Nx*Ny)
+        neighbours.append([(x+dx) + ((y+dy) + (z+dz)*Ny)*Nx for dx, dy, dz in Map.directions
+                           if 0 <= x+dx < Nx and 0 <= y+dy < Ny and 0 <= z+dz < Nz
+                           and grid[(x+dx) + ((y+dy) + (z+dz)*Ny)*Nx] != Map.outside_code])
+
+    fields = [None] * (m.maxcp + 1)
+    for stage in range(m.maxcp, -1, -1):
+        seeds = defaultdict(list)
+        for i, code in enumerate(grid):
+            if not code: continue
+            bt = (code >> 12) & 7
+            if stage == m.maxcp and bt == 0:
+                seeds[0].append(i)
+            elif stage < m.maxcp and bt == stage + 4 and fields[stage+1][i] >= 0:
+                seeds[fields[stage+1][i]].append(i)
+        field = array('l', [-1]) * len(grid)
+        # Cells are marked once queued, so that each is expanded once
+        d, frontier = 0, []
+        while frontier or seeds:
+            for i in seeds.pop(d, []):
+                if field[i] < 0:
+                    field[i] = d
+                    frontier.append(i)
+            reached = []
+            for i in frontier:
+                for j in neighbours[i]:
+                    if field[j] < 0:
+                        field[j] = d + 1
+                        reached.append(j)
+            frontier = reached
+            d += 1
+        fields[stage] = field
+    return fields
+
+def staged_bound(m):
+    """Return an admissible estimate of the moves a state needs to win,
+    tighter than kinematic_bound on maps with walls and checkpoints.
+
+    The cells a move sweeps make a chain of linked cells as long as its
+    speed along its fastest axis, plus one for each block it touches on the
+    way (see cell_distances). The estimate is the largest of kinematic_bound
+    and of the moves to travel the distance left at full acceleration."""
+    kinematic, fields = kinematic_bound(m), cell_distances(m)
+    Nx, Ny, maxcp = m.Nx, m.Ny, m.maxcp
+    moves = functools.cache(travel_moves)
+    def estimate(state):
+        h = kinematic(state)
+        if h is None: return None
+        Px, Py, Pz, Vx, Vy, Vz, checkpoint = state
+        d = fields[checkpoint][Px + (Py + Pz*Ny)*Nx]
+        if d < 0: return None
+        distance = d - (maxcp - checkpoint) - 1
+        if distance > 0:
+            h = max(h, moves(distance, max(abs(Vx), abs(Vy), abs(Vz))) - 1e-9)
+        return h
+    return estimate
+
+class AStarExpander:
+    """Expands states for astar_solve, in its own process or in workers."""
+
+    def __init__(self, m, staged=False):
+        self.m, self.space = m, StateSpace(m)
+        self.estimate = staged_bound(m) if staged else kinematic_bound(m)
+
+    def __call__(self, indices):
+        """Return, for each state index, the states it leads to as
+        (index, acceleration, estimate) and its victories as (submoves,
+        acceleration). States that cannot win are left out."""
+        m, space, estimate = self.m, self.space, self.estimate
+        expanded = []
+        for index in indices:
+            states, victories = [], []
+            for A, result in m.successors(space.unpack(index), prune=True):
+                if isinstance(result, Map.State):
+                    h = estimate(result)
+                    if h is not None: states.append((space.pack(result), A, h))
+                elif result.ok:
+                    victories.append((result.moves, A))
+            expanded.append((states, victories))
+        return expanded
+
+worker_expander = None
+
+def init_worker(m, staged):
+    global worker_expander
+    worker_expander = AStarExpander(m, staged)
+
+def worker_expand(indices):
+    return worker_expander(indices)
+
+SolveProgress = namedtuple('SolveProgress', 'moves lower_bound nodes frontier memory'.split())
+
+def anytime_solve(m, jobs=1, batch_size=256, time_budget=None, max_nodes=None,
+                  cancel=None, callback=None, report_every=4096, staged=False, weight=1,
+                  max_memory=None, spill_dir=None, checkpoint_file=None, checkpoint_every=60):
+    """Search a path with the fewest moves with an A* search guided by
+    kinematic_bound, or staged_bound when staged is set, that can be
+    stopped at any time.
+
+    The search stops after time_budget seconds of wall clock time, after
+    max_nodes states are expanded, once cancel.is_set() (e.g. a
+    threading.Event) or on KeyboardInterrupt. callback is given a
+    SolveProgress every report_every expanded states and for each better
+    path found: the moves of the best path so far (None until one is
+    found), a lower bound on the fewest moves, the states expanded and
+    left to explore, and the bytes they take.
+
+    Return a SolveResult: the best path found and its moves ([] and None if
+    there is none), a lower bound on the fewest moves (inf when the map
+    cannot be won), whether the moves are proven to be the fewest, and the
+    states expanded.
+
+    With several jobs, the batch_size states with the lowest estimates are
+    expanded at once by a pool of worker processes, and merged back in
+    order. This may expand states the serial search would not have, but
+    states reached again with fewer moves are expanded again, so the moves
+    found are the same.
+
+    With a weight above 1, estimates are multiplied by it: the search
+    expands fewer states, and the path found has at most weight times the
+    fewest moves.
+
+    Once the state table and the frontier take more than max_memory bytes,
+    the table moves to memory-mapped files (see StateTable) and the frontier
+    keeps about half of max_memory, writing the rest in sorted runs (see
+    Frontier). Both go to spill_dir, or to a temporary directory. The search
+    goes on slower, at the pace the system pages the files in and out.
+
+    With a checkpoint_file, the search is saved to it every
+    checkpoint_every seconds and when it stops, and resumes from it when it
+    holds a search of the same map, staged and weight. The states expanded
+    and max_nodes then count those of the runs before.
+    """
+    if not m.valid: return SolveResult([], None, math.inf, True, 0)
+
+    expand = AStarExpander(m, staged)
+    space, estimate = expand.space, expand.estimate
+    h = estimate(m.startstate)
+    if h is None: return SolveResult([], None, math.inf, True, 0)
+
+    # Heap entries are ints ordered by estimated moves, in 2**-20 moves,
+    # then deeper states first, then the state index, space.size standing
+    # for a victory. Distinct move counts are at least 1/3750 apart, so the
+    # rounding never puts a path before a shorter one.
+    ibits = space.size.bit_length()
+    def entry(f, moves, index):
+        return (math.floor(f * (1 << 20)) << 16 | (0xffff - moves)) << ibits | index
+    toexplore = Frontier((ibits + 16 + 40 + 7) // 8)
+
+    temporary = None
+    def spill_directory():
+        nonlocal temporary
+        if spill_dir is not None: return spill_dir
+        if temporary is None: temporary = tempfile.TemporaryDirectory()
+        return temporary.name
+    def bound_frontier():
+        # The frontier keeps half the memory ceiling, the rest goes to sorted runs
+        toexplore.directory = spill_directory()
+        toexplore.limit = max(max_memory // 2 // (sys.getsizeof(1 << 8*toexplore.width) + 8), 1024)
+
+    infos, final, count, lower_bound = None, None, 0, 0
+    header = dict(digest=m.digest(), engine=Map.engine_version, staged=staged, weight=weight,
+                  values=StateTable.value_type)
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'rb') as f:
+            saved = json.loads(f.readline())
+            if all(saved.get(key) == value for key, value in header.items()):
+                mapped = max_memory is not None and StateTable.slot_size * saved['capacity'] > max_memory // 2
+                infos = StateTable.load(f, saved['capacity'], saved['states'], spill_directory() if mapped else None)
+                if mapped:
+                    bound_frontier()
+                toexplore.load(f, saved['frontier'])
+                count, lower_bound = saved['count'], saved['lower_bound']
+                if saved['final']:
+                    nmoves, index, A = saved['final']
+                    final = (nmoves, index, tuple(A))
+    if infos is None:
+        infos = StateTable()
+        initial = space.pack(m.startstate)
+        infos[initial] = 0
+        toexplore.push(entry(weight * h, 0, initial))
+
+    def save_checkpoint():
+        with open(checkpoint_file + '.tmp', 'wb') as f:
+            saved = dict(header, count=count, lower_bound=lower_bound, final=final,
+                         capacity=len(infos.keys), states=infos.count, frontier=len(toexplore))
+            f.write(json.dumps(saved).encode() + b'\n')
+            infos.save(f)
+            toexplore.save(f)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+    # The lowest estimate left is a lower bound, as some state of a path
+    # with the fewest moves is always left to explore
+    def update_lower_bound():
+        nonlocal lower_bound
+        if toexplore:
+            lower_bound = max(lower_bound, (toexplore.first() >> ibits + 16) / (1 << 20) / weight)
+    def memory():
+        return (infos.nbytes if infos.directory is None else 0) + toexplore.nbytes
+    def report():
+        update_lower_bound()
+        callback(SolveProgress(final and final[0], lower_bound, count, len(toexplore), memory()))
+
+    deadline = time.monotonic() + time_budget if time_budget is not None else None
+    next_checkpoint = time.monotonic() + checkpoint_every
+    pool = multiprocessing.Pool(jobs, init_worker, (m, staged)) if jobs > 1 else None
+    try:
+        try:
+            while toexplore:
+                if (deadline is not None and time.monotonic() >= deadline) or \
+                   (max_nodes is not None and count >= max_nodes) or \
+                   (cancel is not None and cancel.is_set()):
+                    break
+                batch = []
+                while toexplore and len(batch) < (batch_size if pool else 1):
+                    index = toexplore.first() & ((1 << ibits) - 1)
+                    if index == space.size: break # Victory, no state left can do better
+                    e = toexplore.pop()
+                    moves = infos.get(index) >> 8
+                    if moves != 0xffff - ((e >> ibits) & 0xffff): continue # Reached again with fewer moves
+                    batch.append((index, moves))
+                if not batch: break
+
+                indices = [index for index, moves in batch]
+                if pool:
+                    chunks = [indices[i::jobs] for i in range(jobs)]
+                    expanded = [None] * len(batch)
+                    for i, chunk in enumerate(pool.map(worker_expand, chunks)):
+                        expanded[i::jobs] = chunk
+                else:
+                    expanded = expand(indices)
+
+                for (index, moves), (states, victories) in zip(batch, expanded):
+                    count += 1
+                    checkpoint = index % space.Ncp
+                    for rindex, A, h in states:
+                        value = infos.get(rindex)
+                        if value is not None and value >> 8 <= moves + 1: continue
+                        infos[rindex] = StateTable.value(moves + 1, checkpoint, *A)
+                        toexplore.push(entry(moves + 1 + weight * h, moves + 1, rindex))
+                    for submoves, A in victories:
+                        nmoves = moves + submoves
+                        if not final or nmoves < final[0]:
+                            final = (nmoves, index, A)
+                            toexplore.push(entry(nmoves, 0xffff, space.size))
+                            if callback: report()
+                    if callback and count % report_every == 0: report()
+
+                # Past the ceiling, the table goes to mapped files and the
+                # frontier keeps half the ceiling in memory
+                if max_memory is not None and infos.directory is None and memory() > max_memory:
+                    infos = infos.spill(spill_directory())
+                    bound_frontier()
+                    toexplore.spill()
+                if checkpoint_file is not None and time.monotonic() >= next_checkpoint:
+                    update_lower_bound()
+                    save_checkpoint()
+                    next_checkpoint = time.monotonic() + checkpoint_every
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if pool: pool.terminate()
+
+        optimal = not toexplore or (weight == 1 and toexplore.first() & ((1 << ibits) - 1) == space.size)
+        update_lower_bound()
+        if checkpoint_file is not None:
+            save_checkpoint()
+        if optimal:
+            lower_bound = final[0] if final else math.inf
+        if final:
+            nmoves, index, A = final
+            return SolveResult(infos.path(space, index) + [A], nmoves, min(lower_bound, nmoves), optimal, count)
+        return SolveResult([], None, lower_bound, optimal, count)
+    finally:
+        infos.close()
+        toexplore.close()
+        if temporary is not None: temporary.cleanup()
+
+def astar_solve(m, progress=False, jobs=1, batch_size=256, staged=False, store=None):
+    """Find a path with the fewest moves with anytime_solve, run to the
+    end. Return (path, moves) as bruteforce_solve does, moves being proven
+    optimal, or ([], 0) when the map cannot be won. With a SolutionStore,
+    a result it holds is returned without searching."""
+    def report(p):
+        print(f"{p.nodes} states expanded, {p.frontier} to explore, {p.memory >> 20} MB,"
+              f" best {p.moves}, at least {p.lower_bound:.3f} moves", file=sys.stderr)
+    kwargs = dict(jobs=jobs, batch_size=batch_size, callback=report if progress else None, staged=staged)
+    result = store.solve(m, anytime_solve, **kwargs) if store else anytime_solve(m, **kwargs)
+    return result.path, result.moves or 0
+
+def map_files(patterns):
+    """Expand files, directories (every .map and postmortem .txt.gz file
+    in them) and glob patterns into a sorted list of map files."""
+    files = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files.update(glob.glob(os.path.join(pattern, '*.map')))
+            files.update(glob.glob(os.path.join(pattern, '*.txt.gz')))
+        else:
+            files.update(glob.glob(pattern) or [pattern])
+    return sorted(files)
+
+def read_map(filename):
+    """Read a map file, gzipped ones included. The postmortem archive files
+    hold a path after the map, the parser ignores it."""
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as f:
+        return Map(f.read())
+
+def init_batch_worker(max_memory):
+    if max_memory is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+def solve_file(filename, time_budget=None, max_nodes=None, staged=False, store=None):
+    """Solve a map file with anytime_solve and return its record for
+    batch_solve, as a dict that converts to JSON. store is the file name of
+    a SolutionStore to look the map up in and to keep the result in."""
+    record = dict(map=filename, moves=None, optimal=False, lower_bound=None, path=[], nodes=0, error=None,
+                  invalid=False)
+    start = time.monotonic()
+    try:
+        m = read_map(filename)
+        record['error'] = m.find_error()
+        record['invalid'] = record['error'] is not None
+        if not record['error']:
+            kwargs = dict(time_budget=time_budget, max_nodes=max_nodes, staged=staged)
+            if store:
+                with SolutionStore(store) as solutions:
+                    result = solutions.solve(m, anytime_solve, **kwargs)
+            else:
+                result = anytime_solve(m, **kwargs)
+            record.update(moves=result.moves, optimal=result.optimal, path=result.path, nodes=result.nodes,
+                          lower_bound=result.lower_bound if math.isfinite(result.lower_bound) else None)
+    except MemoryError:
+        record['error'] = "Out of memory"
+    except (OSError, UnicodeDecodeError) as e:
+        record['error'] = str(e)
+    record['time'] = time.monotonic() - start
+    return record
+
+def solve_map_data(map_data, time_budget=None, store=None):
+    """Solve a map description with anytime_solve, for the worker processes
+    of the server. store is the file name of a SolutionStore to look the map
+    up in and to keep the result in."""
+    m = Map(map_data)
+    if store:
+        with SolutionStore(store) as solutions:
+            return solutions.solve(m, anytime_solve, time_budget=time_budget)
+    return anytime_solve(m, time_budget=time_budget)
+
+def batch_solve(filenames, jobs=1, time_budget=None, max_nodes=None, max_memory=None, staged=False, store=None):
+    """Solve map files in a pool of worker processes, each map in a fresh
+    process whose address space is capped to max_memory bytes. Yield the
+    record of each map (see solve_file) as soon as it is solved."""
+    solve = functools.partial(solve_file, time_budget=time_budget, max_nodes=max_nodes, staged=staged, store=store)
+    with multiprocessing.Pool(jobs, init_batch_worker, (max_memory,), maxtasksperchild=1) as pool:
+        yield from pool.imap_unordered(solve, filenames)
+
+def solved_files(output):
+    """Return the maps an NDJSON output of a previous run is done with: the
+    ones proven optimal or impossible, and the invalid ones. The ones it
+    ran out of time, nodes or memory on are searched again."""
+    try:
+        with open(output, 'r') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+            return {r['map'] for r in records if r['optimal'] or r.get('invalid')}
+    except FileNotFoundError:
+        return set()
+
 if __name__ == '__main__':
-    import argparse, sys
+    import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('map_file')
+    parser.add_argument('map_file', nargs='+', help="Map file, or with --batch, map files, directories or globs")
     parser.add_argument('--deep', '-d', action='store_true', help="Deeper search")
+    parser.add_argument('--astar', '-a', action='store_true', help="Search a path with the fewest moves")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Processes for the search with the fewest moves")
+    parser.add_argument('--time-budget', '-t', type=float, help="Seconds before giving the best path found so far")
+    parser.add_argument('--max-nodes', '-n', type=int, help="States expanded before giving the best path found so far")
+    parser.add_argument('--staged', '-s', action='store_true', help="Estimate moves from distances to each checkpoint")
+    parser.add_argument('--weight', '-w', type=float, default=1, help="Accept paths up to this times the fewest moves")
+    parser.add_argument('--batch', '-b', metavar='OUTPUT', help="Solve every map to NDJSON records appended to OUTPUT ('-' for stdout), skipping maps it already has proven or found invalid")
+    parser.add_argument('--max-memory', '-m', type=int, help="Megabytes of memory for each map in batch mode")
+    parser.add_argument('--store', metavar='FILE', help="SQLite file of solutions to reuse and to keep results in")
+    parser.add_argument('--spill-memory', type=int, metavar='MB', help="Megabytes of search tables before moving them to disk")
+    parser.add_argument('--spill-dir', metavar='DIR', help="Directory of the search tables moved to disk")
+    parser.add_argument('--checkpoint', metavar='FILE', help="File to save the search to, and to resume it from")
     args = parser.parse_args()
 
-    with open(args.map_file, 'r') as f:
-        the_map = Map(f.read())
+    if args.batch:
+        filenames = map_files(args.map_file)
+        if args.batch != '-':
+            done = solved_files(args.batch)
+            filenames = [filename for filename in filenames if filename not in done]
+        max_memory = args.max_memory << 20 if args.max_memory is not None else None
+        with (open(args.batch, 'a') if args.batch != '-' else sys.stdout) as output:
+            for n, record in enumerate(batch_solve(filenames, args.jobs, args.time_budget, args.max_nodes,
+                                                   max_memory, args.staged, args.store), 1):
+                print(json.dumps(record), file=output, flush=True)
+                print(f"{n}/{len(filenames)} {record['map']}: {record['moves']} moves",
+                      "(optimal)" if record['optimal'] else "", record['error'] or "", file=sys.stderr)
+        sys.exit()
+
+    if len(args.map_file) > 1:
+        parser.error("a single map file is expected without --batch")
+    the_map = read_map(args.map_file[0])
+    store = SolutionStore(args.store) if args.store else None
 
-    path, moves = bruteforce_solve(the_map, not args.deep, True)
+    if args.time_budget is not None or args.max_nodes is not None or args.weight != 1 or \
+       args.spill_memory is not None or args.checkpoint:
+        kwargs = dict(jobs=args.jobs, time_budget=args.time_budget, max_nodes=args.max_nodes,
+                      callback=lambda p: print(p, file=sys.stderr), staged=args.staged, weight=args.weight,
+                      max_memory=args.spill_memory and args.spill_memory << 20, spill_dir=args.spill_dir,
+                      checkpoint_file=args.checkpoint)
+        result = store.solve(the_map, anytime_solve, **kwargs) if store else anytime_solve(the_map, **kwargs)
+        print(f"Lower bound: {result.lower_bound:.3f}", "(optimal)" if result.optimal else "", file=sys.stderr)
+        path, moves = result.path, result.moves or 0
+    elif args.astar or args.staged or args.jobs > 1 or store:
+        path, moves = astar_solve(the_map, True, args.jobs, staged=args.staged, store=store)
+    else:
+        path, moves = bruteforce_solve(the_map, not args.deep, True)
 
     if not path:
         print("No path found")
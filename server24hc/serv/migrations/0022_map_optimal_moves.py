@@ -0,0 +1,18 @@
+# Generated by Django 5.0.2 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('serv', '0021_team_score_game_team_score_player'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='map',
+            name='optimal_moves',
+            field=models.FloatField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.2 on 2026-10-18 16:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('serv', '0022_map_optimal_moves'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Deal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField()),
+                ('map', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='serv.map')),
+                ('player', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('stage', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='serv.stage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['stage', 'player', 'position'], name='serv_deal_stage_i_927306_idx')],
+            },
+        ),
+    ]
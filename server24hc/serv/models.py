@@ -1,9 +1,276 @@
-from django.db import models
+import concurrent.futures
+import contextlib
+import functools
+import math
+import multiprocessing
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Count, F, Max, Min, Q, Window
+from django.db.models.functions import RowNumber
+from django.db.models.signals import m2m_changed, post_delete, pre_delete
+from django.dispatch import receiver
 from django.utils import timezone
 from django.contrib.auth.models import User
 
 from .maputils import Map as MapUtils
-from .bruteforce_solve import bruteforce_solve
+from .bruteforce_solve import bruteforce_solve, init_batch_worker, solve_map_data
+from .solutions import SolutionStore
+
+@functools.lru_cache(maxsize=32)
+def map_utils(map_data):
+    """Shared parsed map, with a transition cache, so that rescoring every
+    game played on a map only simulates each distinct move once."""
+    m = MapUtils(map_data)
+    m.enable_transition_cache()
+    return m
+
+def stored_solution(map_data):
+    """Return the result settings.SOLUTION_STORE proves for a map, None if
+    it holds no proven one."""
+    m = map_utils(map_data)
+    if not settings.SOLUTION_STORE or not m.valid: return None
+    with SolutionStore(settings.SOLUTION_STORE) as store:
+        result = store.get(m)
+    return result if result is not None and result.optimal else None
+
+solver_pool = None
+
+def prove_solvability(map_obj):
+    """Search the map once the transaction saving it commits, in a pool of
+    settings.MAP_SOLVER_WORKERS processes (0 to search in the calling
+    thread), and record on its row whether it can be won and in how many
+    moves at best. A search that runs out of settings.MAP_SOLVER_TIME_BUDGET
+    leaves the map unknown, for the stage close to decide."""
+    args = (map_obj.map_data, settings.MAP_SOLVER_TIME_BUDGET,
+            settings.SOLUTION_STORE and str(settings.SOLUTION_STORE))
+    if not settings.MAP_SOLVER_WORKERS:
+        transaction.on_commit(lambda: map_obj.record_solution(solve_map_data(*args)))
+        return
+    def done(future):
+        if future.exception() is not None: return
+        try:
+            map_obj.record_solution(future.result())
+        finally:
+            connection.close() # Opened by this thread of the pool
+    transaction.on_commit(lambda: submit_solver(args, done))
+
+def submit_solver(args, done):
+    """Search solve_map_data(*args) in the solver pool, started on first use
+    and started again if a worker died, which breaks it for good. A map
+    that can't be submitted is left unknown rather than failing its
+    submission."""
+    global solver_pool
+    for attempt in range(2):
+        if solver_pool is None:
+            # Spawned, as forking a threaded server process is unsafe
+            solver_pool = concurrent.futures.ProcessPoolExecutor(
+                settings.MAP_SOLVER_WORKERS, multiprocessing.get_context('spawn'),
+                init_batch_worker, (settings.MAP_SOLVER_MAX_MEMORY,))
+        try:
+            solver_pool.submit(solve_map_data, *args).add_done_callback(done)
+            return
+        except BrokenProcessPool:
+            solver_pool = None
+
+def scope(stage=None, map=None, prefix=''):
+    """Filter keyword arguments restricting a query to a stage and a map
+    id, either of them None for any, through the prefix relation."""
+    return {prefix + k: v for k, v in (('stage_id', stage), ('map_id', map)) if v is not None}
+
+def player_scores(users, stage=None, map=None):
+    """Return the player score of each user id of users, as a dict, over
+    the maps of every stage, or only over a stage and/or map id.
+
+    A fixed number of queries whatever the number of teams, stages and maps:
+    the maps of each stage, the best and worst winning reference score of
+    each map in each stage, and the latest game of each user on each of
+    them. See Team.compute_score_player for the rules."""
+    stage_maps = Stage.maps.through.objects.filter(stage__dev=False, **scope(stage, map)) \
+        .values_list('stage_id', 'map_id')
+    victories = {(s, m): (best, worst) for s, m, best, worst in
+                 Game.objects.filter(stage__dev=False, finished=True, victory=True, **scope(stage, map))
+                     .values('stage_id', 'map_id').order_by()
+                     .annotate(best=Min('reference_score'), worst=Max('reference_score'))
+                     .values_list('stage_id', 'map_id', 'best', 'worst')}
+    latest = {(s, m, p): (reference_score, victory) for s, m, p, reference_score, victory in
+              Game.objects.filter(stage__dev=False, finished=True, player_id__in=users, **scope(stage, map))
+                  # Games closed unplayed with the stage have no score and count as not played
+                  .exclude(reference_score=None)
+                  .annotate(rank=Window(RowNumber(), partition_by=[F('stage_id'), F('map_id'), F('player_id')],
+                                        order_by=F('completed_at').desc()))
+                  .filter(rank=1)
+                  .values_list('stage_id', 'map_id', 'player_id', 'reference_score', 'victory')}
+
+    scores = dict.fromkeys(users, 0)
+    for s, m in stage_maps:
+        best, worst = victories.get((s, m), (None, None))
+        for user in scores:
+            g = latest.get((s, m, user))
+            if g is None:
+                # The team didn't play => 10*worst_score
+                # If no game has been won on the map => neutralized.
+                if worst is not None:
+                    scores[user] += 10*worst
+            elif best is not None:
+                reference_score, victory = g
+                scores[user] += reference_score - best
+                if not victory: # if the team lost => golf score +  2*golf score of the worst game
+                    scores[user] += 2*(worst - best)
+    return scores
+
+def game_scores(users, stage=None, map=None):
+    """Return the game designer score of each user id of users, as a dict,
+    over every stage, or only over a stage and/or map id, less the missing
+    maps of each stage when over a map.
+
+    A fixed number of queries whatever the number of teams, stages and maps:
+    the stages, their maps with proposer, and counts of games and of scores
+    grouped by stage and map. See Team.compute_score_game for the rules."""
+    stages = Stage.objects.filter(dev=False, **({} if stage is None else {'pk': stage})) \
+        .values_list('id', 'number_of_maps')
+    stage_maps = Stage.maps.through.objects.filter(stage__dev=False, **scope(stage, map)) \
+        .values_list('stage_id', 'map_id', 'map__proposed_by_id', 'map__impossible')
+    games = {(s, m): (proposer, total, played, won) for s, m, proposer, total, played, won in
+             Game.objects.filter(stage__dev=False, **scope(stage, map))
+                 .values('stage_id', 'map_id', 'map__proposed_by_id').order_by()
+                 .annotate(total=Count('id'), played=Count('id', filter=~Q(moves='')),
+                           won=Count('id', filter=Q(finished=True, victory=True)))
+                 .values_list('stage_id', 'map_id', 'map__proposed_by_id', 'total', 'played', 'won')}
+    scores = {(s, m): (proposer, total, wrong) for s, m, proposer, total, wrong in
+              Score.objects.filter(game__stage__dev=False, **scope(stage, map, prefix='game__'))
+                  .values('game__stage_id', 'game__map_id', 'game__map__proposed_by_id').order_by()
+                  .annotate(total=Count('id'), wrong=Count('id', filter=Q(valid=False, referee=F('game__map__proposed_by'))
+                                                                     & ~Q(game__moves='')))
+                  .values_list('game__stage_id', 'game__map_id', 'game__map__proposed_by_id', 'total', 'wrong')}
+
+    # Per stage and proposer: maps in the stage, played games and scores on their maps
+    proposed, played, scored = defaultdict(int), defaultdict(int), defaultdict(int)
+    for (s, m), (proposer, total, nplayed, won) in games.items():
+        played[s, proposer] += nplayed
+    for (s, m), (proposer, total, wrong) in scores.items():
+        scored[s, proposer] += total
+
+    results = dict.fromkeys(users, 0)
+    for s, m, proposer, impossible in stage_maps:
+        proposed[s, proposer] += 1
+        if proposer not in results: continue
+        _, total, nplayed, won = games.get((s, m), (proposer, 0, 0, 0))
+        # +1 point per winning game on the map
+        results[proposer] += won
+        # +10 points per map with at least one wrongly scored game
+        results[proposer] += 10*(scores.get((s, m), (proposer, 0, 0))[2] > 0)
+        # 20point per game on a map nobody managed to solve (Games *must* provide possible maps)
+        if impossible:
+            results[proposer] += 20*total
+    for s, number_of_maps in stages:
+        if number_of_maps > 0:
+            for user in results:
+                # 10 points for each missing map
+                if map is None:
+                    results[user] += 10*(number_of_maps - proposed[s, user])
+                # 20 points for each game played and valid but that hasn't been scored
+                results[user] += 20*(played[s, user] - scored[s, user])
+    return results
+
+@contextlib.contextmanager
+def live_scores(stage, map, players=True):
+    """Context applying to the saved scores of the teams the change the
+    writes in its block make on the scores of a stage and map id: the
+    player scores of every team on the map (its best and worst winning
+    games score them all) if players, and the game designer score of its
+    proposer. Only that map in that stage is computed, before and after the
+    block, in a transaction holding a lock on the map row so that
+    concurrent writes on it apply their changes one after the other.
+    Team.update_scores recomputes them all from scratch."""
+    with transaction.atomic():
+        proposer = list(Map.objects.select_for_update().filter(pk=map).values_list('proposed_by_id', flat=True))
+        users = list(Team.objects.values_list('user_id', flat=True))
+        if stage is None or not users or not Stage.objects.filter(pk=stage, dev=False).exists():
+            yield
+            return
+        designers = [user for user in proposer if user in users]
+        def snapshot():
+            return (player_scores(users, stage, map) if players else {},
+                    game_scores(designers, stage, map) if designers else {})
+        before = snapshot()
+        yield
+        add_scores(users, before, snapshot())
+
+def add_scores(users, before, after):
+    """Add to the saved scores of the teams of users the change from
+    before to after, both (player scores, game designer scores) dicts."""
+    for user in users:
+        player = after[0].get(user, 0) - before[0].get(user, 0)
+        game = after[1].get(user, 0) - before[1].get(user, 0)
+        if player or game:
+            Team.objects.filter(user_id=user).update(score_player=F('score_player') + player,
+                                                     score_game=F('score_game') + game)
+
+held_scores = threading.local()
+
+def stage_scores(stage):
+    """Return every team user with their (player scores, game designer
+    scores) over a stage id, locking the maps of the stage until the end
+    of the transaction so that live_scores waits for the caller."""
+    list(Map.objects.select_for_update().filter(stage=stage).values_list('pk'))
+    users = list(Team.objects.values_list('user_id', flat=True))
+    return users, (player_scores(users, stage), game_scores(users, stage))
+
+def hold_scores(stages, new=False):
+    """Take the scores of the teams over each stage id, none for new ones,
+    for apply_scores to apply their change after writes live_scores doesn't
+    cover: the maps of a stage and its quota, and deletions."""
+    if not hasattr(held_scores, 'stages'):
+        held_scores.stages = {}
+    for stage in stages:
+        held_scores.stages[stage] = ({}, {}) if new else stage_scores(stage)[1]
+
+def apply_scores(stages):
+    """Add to the saved scores of the teams their change over each stage id
+    since hold_scores, and hold the new ones: a cascade of deletions holds
+    them all before any is deleted, then applies them after each."""
+    if not hasattr(held_scores, 'stages'):
+        held_scores.stages = {}
+    for stage in stages:
+        users, after = stage_scores(stage)
+        add_scores(users, held_scores.stages[stage], after)
+        held_scores.stages[stage] = after
+
+@receiver(m2m_changed, sender='serv.Stage_maps')
+def stage_maps_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        # Gone once cleared
+        instance.scored_stages = list(instance.stage_set.values_list('pk', flat=True)) if reverse else [instance.pk]
+    elif action in ('pre_add', 'pre_remove', 'post_add', 'post_remove'):
+        instance.scored_stages = list(pk_set) if reverse else [instance.pk]
+    (hold_scores if action.startswith('pre_') else apply_scores)(instance.scored_stages)
+
+def deleted_stages(instance):
+    """Return the ids of the stages whose scores deleting instance changes."""
+    if isinstance(instance, Stage):
+        return [instance.pk]
+    if isinstance(instance, Map):
+        return list(Stage.objects.filter(maps=instance).values_list('pk', flat=True))
+    if isinstance(instance, Game):
+        return [instance.stage_id] if instance.stage_id is not None else []
+    if isinstance(instance, Score):
+        return [stage for stage in Game.objects.filter(pk=instance.game_id).values_list('stage', flat=True)
+                if stage is not None]
+    return []
+
+@receiver(pre_delete)
+def hold_deleted_scores(sender, instance, **kwargs):
+    instance.scored_stages = deleted_stages(instance)
+    hold_scores(instance.scored_stages)
+
+@receiver(post_delete)
+def apply_deleted_scores(sender, instance, **kwargs):
+    apply_scores(getattr(instance, 'scored_stages', []))
 
 class Team(models.Model):
     name = models.CharField(max_length=100, unique=True, null=True, blank=True)
@@ -22,50 +289,41 @@ class Team(models.Model):
         return Score.objects.filter(referee=self.user).count()
 
     def compute_score_player(self):
-        score = 0
-        for s in Stage.objects.filter(dev=False):
-            for m in s.maps.all():
-                g = Game.objects.filter(map=m, finished=True, stage=s, player=self.user).order_by('-completed_at').first()
-                worst_score = Game.objects.filter(map=m, finished=True, victory=True, stage=s).order_by('-reference_score').first().reference_score
-                best_scored_game = Game.objects.filter(map=m, finished=True, victory=True, stage=s).order_by('reference_score').first()
-                if g is None:
-                    # The team didn't play => 10*worst_score
-                    if worst_score is not None:
-                        score += 10*worst_score
-                    else: # If no game has been played on the map => neutralized.
-                        score += 0
-                if best_scored_game is not None:
-                    best_score = best_scored_game.reference_score
-                    current_player_score = g.reference_score
-                    score += current_player_score - best_score
-                    # if the team won => golf score
-                    if not game.victory: # if the team lost => golf score +  2*golf score of the worst game
-                        score += 2*(worst_score - best_score)
-        return score
-
-    def compute_score_game(self):
-        score = 0
-        for s in Stage.objects.filter(dev=False):
-            if s.number_of_maps > 0:
-                # 100 points for each missing map
-                score += 10*(s.number_of_maps - s.maps.filter(proposed_by=self.user).count())
-                # 20 points for each game played and valid but that hasn't been scored
-                score += 20*(Game.objects.filter(stage=s, map__proposed_by=self.user).exclude(moves='').count() - Score.objects.filter(game__map__proposed_by=self.user, game__stage=s).count())
-            for m in s.maps.filter(proposed_by=self.user):
-                # +1 point per winning game on the map
-                winning_games = Game.objects.filter(map=m, finished=True, victory=True, stage=s).count()
-                score += winning_games
+        """Golf score of the team as a player, over the maps of every stage
+        but the dev ones, from its latest game on each: its reference score
+        minus the best winning one, plus twice the spread of the winning
+        ones if it lost. A map the team didn't play costs 10 times the
+        worst winning score, and maps nobody won are neutralized."""
+        return player_scores([self.user_id])[self.user_id]
 
-                # +10 points per map with at least one wrongly scored game
-                wrongly_scored_games = Score.objects.filter(game__map=m, game__stage=s, referee=self.user, valid=False).exclude(game__moves='').count()
-                score += 10*(wrongly_scored_games > 0)
+    @classmethod
+    def update_scores(cls, teams):
+        """Compute and save the scores of the teams, with a single query
+        to save them all."""
+        users = [team.user_id for team in teams]
+        players, games = player_scores(users), game_scores(users)
+        for team in teams:
+            team.score_player, team.score_game = players[team.user_id], games[team.user_id]
+        cls.objects.bulk_update(teams, ['score_player', 'score_game'])
 
-                # 20point per game on a map nobody managed to solve (Games *must* provide possible maps)
-                number_of_games = Game.objects.filter(map=m, stage=s).count()
-                if m.impossible is not None and m.impossible:
-                    score += number_of_games*20
+    @classmethod
+    def stale_scores(cls, teams):
+        """Return the teams whose saved scores differ from a recomputation,
+        with their recomputed player and game designer scores."""
+        users = [team.user_id for team in teams]
+        players, games = player_scores(users), game_scores(users)
+        # Saved scores add up changes in another order than a recomputation
+        return [(team, players[team.user_id], games[team.user_id]) for team in teams
+                if not (math.isclose(team.score_player, players[team.user_id], abs_tol=1e-6) and
+                        math.isclose(team.score_game, games[team.user_id], abs_tol=1e-6))]
 
-        return score
+    def compute_score_game(self):
+        """Score of the team as a game designer, over every stage but the
+        dev ones: 10 points per map missing from its quota of the stage, 20
+        per game played on its maps and not scored, and per map of its in
+        the stage, 1 per game won on it, 10 if it wrongly scored a game on
+        it and 20 per game on it if nobody could win it."""
+        return game_scores([self.user_id])[self.user_id]
 
     @property
     def score_full(self):
@@ -76,6 +334,7 @@ class Map(models.Model):
     proposed_by = models.ForeignKey(User, on_delete=models.CASCADE)
     proposed_at = models.DateTimeField(auto_now_add=True)
     impossible = models.BooleanField(default=None, blank=True, null=True)
+    optimal_moves = models.FloatField(default=None, blank=True, null=True)
 
     @property
     def size(self):
@@ -92,6 +351,17 @@ class Map(models.Model):
         errors = MapUtils(self.map_data).find_error()
         return errors is None, errors
 
+    def record_solution(self, result):
+        """Record a proven SolveResult of the map on its row, leaving the
+        other fields as they are now in the database."""
+        if result.optimal:
+            self.impossible, self.optimal_moves = result.moves is None, result.moves
+            # Games on impossible maps score their proposer
+            with contextlib.ExitStack() as stack:
+                for stage in Stage.objects.filter(maps=self, dev=False).values_list('pk', flat=True):
+                    stack.enter_context(live_scores(stage, self.pk, players=False))
+                Map.objects.filter(pk=self.pk).update(impossible=self.impossible, optimal_moves=self.optimal_moves)
+
 class Stage(models.Model):
     maps = models.ManyToManyField(Map, null=True, blank=True)
     endpoint = models.CharField(max_length=100, unique=True)
@@ -103,19 +373,37 @@ class Stage(models.Model):
     dev = models.BooleanField(default=False)
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            # Its quota, its dev flag... apply to the scores of a running stage
+            created = self.pk is None
+            if self.running and not created:
+                hold_scores([self.pk])
+            super().save(*args, **kwargs)
+            if self.running:
+                if created:
+                    hold_scores([self.pk], new=True)
+                apply_scores([self.pk])
         if not self.running:
             games = Game.objects.filter(stage=self, finished=False).update(finished=True, victory=False)
             for m in self.maps.filter(impossible=None):
-                if Game.objects.filter(map=m, stage=self, victory=True).count() != 0:
+                solution = stored_solution(m.map_data)
+                if solution is not None:
+                    m.impossible = solution.moves is None
+                elif Game.objects.filter(map=m, stage=self, victory=True).count() != 0:
                     m.impossible = False
                 else:
                     m.impossible = True
                 m.save()
+            # Closing games and maps in bulk changes every score
+            Team.update_scores(list(Team.objects.all()))
 
     def __str__(self):
         return self.endpoint
 
+class AnalysisTimeout(Exception):
+    """Raised by Game.save when the path couldn't be analyzed within
+    settings.PATH_TIME_BUDGET, the game being left unsaved."""
+
 class Game(models.Model):
     map = models.ForeignKey(Map, on_delete=models.CASCADE)
     moves = models.TextField(default="")
@@ -130,18 +418,62 @@ class Game(models.Model):
 
     def save(self, *args, **kwargs):
         if self.finished and self.reference_score is None:
-            m = MapUtils(self.map.map_data)
-            analysis_result = m.analyze_path(self.moves)
+            m = map_utils(self.map.map_data)
+            analysis_result = m.analyze_path(self.moves, settings.PATH_MAX_MOVES, settings.PATH_TIME_BUDGET)
+            if analysis_result.msg == MapUtils.time_budget_msg:
+                # Not the path's fault, it may be analyzed in time once the server is less busy
+                raise AnalysisTimeout(analysis_result.msg)
             self.analysis_message = analysis_result.msg
             self.reference_score = analysis_result.moves
             self.victory = analysis_result.ok
         if self.finished and self.completed_at is None:
             self.completed_at = timezone.now()
-        super().save(*args, **kwargs)
+        # Unfinished games only count for the proposer of the map
+        with live_scores(self.stage_id, self.map_id, players=self.finished):
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Game {self.id} by {self.player.username} on map {self.map.id}"
 
+class Deal(models.Model):
+    """A map of a stage dealt to a player, who gets the ones dealt to them
+    in the order of their position."""
+    stage = models.ForeignKey(Stage, on_delete=models.CASCADE)
+    player = models.ForeignKey(User, on_delete=models.CASCADE)
+    map = models.ForeignKey(Map, on_delete=models.CASCADE)
+    position = models.IntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=['stage', 'player', 'position'])]
+
+    @classmethod
+    def deal(cls, stage, player):
+        """Deal the stage maps the player hasn't played yet in a random
+        order, or in a dev stage every map again once all are played."""
+        maps = set(stage.maps.values_list('id', flat=True))
+        remaining = list(maps.difference(Game.objects.filter(player=player, stage=stage).values_list('map', flat=True)))
+        if stage.dev and not remaining:
+            remaining = list(maps)
+        random.shuffle(remaining)
+        cls.objects.bulk_create(cls(stage=stage, player=player, map_id=m, position=i) for i, m in enumerate(remaining))
+
+    @classmethod
+    def next_map(cls, stage, player):
+        """Take the next map dealt to the player in the stage, dealing them
+        the maps left when none is, and return it, None if there is none
+        left. Within a transaction, as it locks the player until its end so
+        that simultaneous requests of theirs get different maps."""
+        list(User.objects.select_for_update().filter(pk=player.pk).values_list('pk'))
+        # Skip maps removed from the stage since they were dealt
+        dealt = cls.objects.filter(stage=stage, player=player, map__stage=stage).select_related('map')
+        deal = dealt.order_by('position').first()
+        if deal is None:
+            cls.deal(stage, player)
+            deal = dealt.order_by('position').first()
+            if deal is None: return None
+        deal.delete()
+        return deal.map
+
 class Score(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
     score = models.FloatField()
@@ -151,7 +483,8 @@ class Score(models.Model):
     def save(self, *args, **kwargs):
         if self.game.reference_score == self.score or abs(self.score - self.game.reference_score)/self.game.reference_score < 0.01:
             self.valid = True
-        super().save(*args, **kwargs)
+        with live_scores(self.game.stage_id, self.game.map_id, players=False):
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return self.referee.username + " - " + str(self.score)
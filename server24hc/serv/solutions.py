@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+
+import json
+import sqlite3
+import time
+from collections import namedtuple
+
+from .maputils import Map
+
+SolveResult = namedtuple('SolveResult', 'path moves lower_bound optimal nodes'.split())
+
+class SolutionStore:
+    """Solver results kept in an SQLite file, keyed by Map.digest.
+
+    Entries record the engine_version of the Map they were found with: the
+    ones of another version are dropped when the store is opened, as the
+    simulation they were proven against has changed. A proven result is only
+    replaced by a search of a newer engine."""
+
+    schema = """CREATE TABLE IF NOT EXISTS solutions (
+        digest TEXT PRIMARY KEY,
+        engine INTEGER NOT NULL,
+        moves REAL,
+        lower_bound REAL NOT NULL,
+        optimal INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        nodes INTEGER NOT NULL,
+        solver TEXT NOT NULL,
+        options TEXT NOT NULL,
+        time REAL NOT NULL,
+        solved_at REAL NOT NULL)"""
+
+    def __init__(self, filename):
+        # Writers of other processes (batch workers, server) wait on the lock
+        self.db = sqlite3.connect(filename, timeout=60)
+        with self.db:
+            self.db.execute(self.schema)
+            self.db.execute("DELETE FROM solutions WHERE engine != ?", (Map.engine_version,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def get(self, m):
+        """Return the stored SolveResult of a map, None if it has none."""
+        row = self.db.execute("SELECT path, moves, lower_bound, optimal, nodes FROM solutions"
+                              " WHERE digest = ? AND engine = ?", (m.digest(), Map.engine_version)).fetchone()
+        if row is None: return None
+        path, moves, lower_bound, optimal, nodes = row
+        return SolveResult([tuple(A) for A in json.loads(path)], moves, lower_bound, bool(optimal), nodes)
+
+    def put(self, m, result, solver='', options={}, elapsed=0):
+        """Store the SolveResult of a map, unless a proven one is stored."""
+        with self.db:
+            self.db.execute("""INSERT INTO solutions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (digest) DO UPDATE SET engine = excluded.engine, moves = excluded.moves,
+                    lower_bound = excluded.lower_bound, optimal = excluded.optimal, path = excluded.path,
+                    nodes = excluded.nodes, solver = excluded.solver, options = excluded.options,
+                    time = excluded.time, solved_at = excluded.solved_at
+                WHERE NOT optimal OR engine != excluded.engine""",
+                (m.digest(), Map.engine_version, result.moves, result.lower_bound, result.optimal,
+                 json.dumps(result.path), result.nodes, solver, json.dumps(options, sort_keys=True),
+                 elapsed, time.time()))
+
+    def solve(self, m, solve, **kwargs):
+        """Return the proven result stored for the map, or else search it
+        with solve(m, **kwargs), a function returning a SolveResult such as
+        anytime_solve, and store what it finds. The keyword arguments of
+        plain values are recorded along with it."""
+        result = self.get(m)
+        if result is not None and result.optimal:
+            return result
+        start = time.monotonic()
+        result = solve(m, **kwargs)
+        options = {k: v for k, v in kwargs.items() if v is None or isinstance(v, (bool, int, float, str))}
+        self.put(m, result, solve.__name__, options, time.monotonic() - start)
+        return result
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+
+import json
+import lzma
+import math
+import sys
+from array import array
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+Rules = namedtuple('Rules', 'unplayed lost won wrong impossible missing unscored'.split(),
+                   defaults=(10, 2, 1, 10, 20, 10, 20))
+Rules.__doc__ = """Points of the scoring rules, as in documentation/points_stage.rst and
+Team.compute_score_player/compute_score_game: times the worst winning
+score for a map not played, times the spread of the winning scores for a
+lost game, per game won on a map of the team, per map with a wrongly
+scored game, per game on an impossible map, per map missing from the
+quota of a stage, and per game played but not scored."""
+
+Standing = namedtuple('Standing', 'user name player game published_player published_game'.split())
+
+def records(filename):
+    """Yield the records of a dumpdata file, xz compressed or not, either a
+    JSON list or one record per line as a streaming export writes them."""
+    with (lzma.open if str(filename).endswith('.xz') else open)(filename, 'rt') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '[':
+            yield from json.loads(first + f.read())
+            return
+        for line in f:
+            line = first + line
+            first = ''
+            if line.strip():
+                yield json.loads(line)
+
+def timestamp(date):
+    return datetime.fromisoformat(date).timestamp() if date else -math.inf
+
+class Event:
+    """The teams, stages, maps, games and scores of an event, as columns of
+    arrays indexed by row rather than objects, a few bytes per game."""
+
+    def __init__(self, records=()):
+        self.teams = {} # user: (name, score_player, score_game)
+        self.stage_number_of_maps = {} # Non dev stages only
+        self.stage_map, self.map_stage = array('l'), array('l')
+        self.map_proposer, self.map_impossible = {}, {} # impossible: 1, 0 or -1 for unknown
+        self.game_id, self.game_stage, self.game_map, self.game_player = (array('l') for i in range(4))
+        self.game_played, self.game_finished, self.game_victory = (array('b') for i in range(3))
+        self.game_reference_score, self.game_completed_at = array('d'), array('d')
+        self.score_game, self.score_referee, self.score_valid = array('l'), array('l'), array('b')
+        stages = {}
+        for record in records:
+            self.add(record, stages)
+        for pk, (dev, maps) in stages.items():
+            if not dev:
+                self.stage_map.extend([pk] * len(maps))
+                self.map_stage.extend(maps)
+        # Rows of the scores from game ids
+        row = {pk: i for i, pk in enumerate(self.game_id)}
+        self.score_game = array('l', (row[pk] for pk in self.score_game))
+
+    def add(self, record, stages):
+        model, pk, fields = record['model'], record['pk'], record['fields']
+        if model == 'serv.team':
+            self.teams[fields['user']] = (fields['name'], fields['score_player'], fields['score_game'])
+        elif model == 'serv.stage':
+            stages[pk] = (fields['dev'], fields['maps'])
+            if not fields['dev']:
+                self.stage_number_of_maps[pk] = fields['number_of_maps']
+        elif model == 'serv.map':
+            impossible = fields.get('impossible')
+            self.map_proposer[pk] = fields['proposed_by']
+            self.map_impossible[pk] = -1 if impossible is None else int(impossible)
+        elif model == 'serv.game':
+            self.game_id.append(pk)
+            self.game_stage.append(fields['stage'] or 0)
+            self.game_map.append(fields['map'])
+            self.game_player.append(fields['player'])
+            self.game_played.append(fields['moves'] != '')
+            self.game_finished.append(fields['finished'])
+            self.game_victory.append(fields['victory'])
+            reference_score = fields['reference_score']
+            self.game_reference_score.append(math.nan if reference_score is None else reference_score)
+            self.game_completed_at.append(timestamp(fields['completed_at']))
+        elif model == 'serv.score':
+            self.score_game.append(fields['game'])
+            self.score_referee.append(fields['referee'])
+            self.score_valid.append(fields['valid'])
+
+    @classmethod
+    def load(cls, filename):
+        return cls(records(filename))
+
+    def player_scores(self, rules=Rules()):
+        """Return the player score of each team user, as a dict."""
+        stages = self.stage_number_of_maps
+        best, worst = {}, {}
+        latest = {} # (stage, map, player): (completed_at, id, row)
+        for i, (s, m, p, finished, victory, reference_score, completed_at, pk) in enumerate(zip(
+                self.game_stage, self.game_map, self.game_player, self.game_finished,
+                self.game_victory, self.game_reference_score, self.game_completed_at, self.game_id)):
+            if not finished or s not in stages: continue
+            if victory:
+                best[s, m] = min(best.get((s, m), reference_score), reference_score)
+                worst[s, m] = max(worst.get((s, m), reference_score), reference_score)
+            key = (s, m, p)
+            # Games closed unplayed with the stage have no score and count as not played
+            if not math.isnan(reference_score) and latest.get(key, (-math.inf,))[:2] < (completed_at, pk):
+                latest[key] = (completed_at, pk, i)
+
+        scores = dict.fromkeys(self.teams, 0)
+        for s, m in zip(self.stage_map, self.map_stage):
+            if (s, m) not in worst: continue # Nobody won the map, neutralized
+            b, w = best[s, m], worst[s, m]
+            for user in scores:
+                g = latest.get((s, m, user))
+                if g is None:
+                    scores[user] += rules.unplayed*w
+                else:
+                    scores[user] += self.game_reference_score[g[2]] - b
+                    if not self.game_victory[g[2]]:
+                        scores[user] += rules.lost*(w - b)
+        return scores
+
+    def game_scores(self, rules=Rules()):
+        """Return the game designer score of each team user, as a dict."""
+        stages = self.stage_number_of_maps
+        total, won = defaultdict(int), defaultdict(int)
+        played, scored, proposed = defaultdict(int), defaultdict(int), defaultdict(int)
+        for s, m, nplayed, finished, victory in zip(self.game_stage, self.game_map, self.game_played,
+                                                    self.game_finished, self.game_victory):
+            if s not in stages: continue
+            total[s, m] += 1
+            won[s, m] += finished and victory
+            played[s, self.map_proposer[m]] += nplayed
+        wrong = set()
+        for g, referee, valid in zip(self.score_game, self.score_referee, self.score_valid):
+            s, m = self.game_stage[g], self.game_map[g]
+            if s not in stages: continue
+            scored[s, self.map_proposer[m]] += 1
+            if not valid and referee == self.map_proposer[m] and self.game_played[g]:
+                wrong.add((s, m))
+
+        scores = dict.fromkeys(self.teams, 0)
+        for s, m in zip(self.stage_map, self.map_stage):
+            proposer = self.map_proposer[m]
+            proposed[s, proposer] += 1
+            if proposer not in scores: continue
+            scores[proposer] += rules.won*won[s, m] + rules.wrong*((s, m) in wrong)
+            if self.map_impossible[m] == 1:
+                scores[proposer] += rules.impossible*total[s, m]
+        for s, number_of_maps in stages.items():
+            if number_of_maps > 0:
+                for user in scores:
+                    scores[user] += rules.missing*(number_of_maps - proposed[s, user])
+                    scores[user] += rules.unscored*(played[s, user] - scored[s, user])
+        return scores
+
+    def standings(self, rules=Rules()):
+        """Return the Standing of each team, from the best total score."""
+        players, games = self.player_scores(rules), self.game_scores(rules)
+        return sorted((Standing(user, name, players[user], games[user], published_player, published_game)
+                       for user, (name, published_player, published_game) in self.teams.items()),
+                      key=lambda standing: (standing.player + standing.game, standing.user))
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Standings of an event from a dumpdata file")
+    parser.add_argument('dump', help="dumpdata file (JSON, one record per line or not, .xz compressed or not)")
+    parser.add_argument('--rule', '-r', action='append', default=[], metavar='NAME=POINTS',
+                        help=f"Change a rule, of {', '.join(Rules._fields)}")
+    parser.add_argument('--json', action='store_true', help="Output the standings as JSON")
+    args = parser.parse_args()
+
+    rules = Rules()
+    for rule in args.rule:
+        name, _, points = rule.partition('=')
+        if name not in Rules._fields:
+            parser.error(f"unknown rule {name}")
+        rules = rules._replace(**{name: float(points)})
+
+    standings = Event.load(args.dump).standings(rules)
+    if args.json:
+        json.dump([s._asdict() for s in standings], sys.stdout, indent=1)
+        sys.exit()
+    print(f"{'':3} {'team':20} {'player':>10} {'game':>10} {'total':>10}  published (diff)")
+    for n, s in enumerate(standings, 1):
+        total, published = s.player + s.game, s.published_player + s.published_game
+        print(f"{n:<3} {str(s.name):20} {s.player:10g} {s.game:10g} {total:10g}  {published:g} ({total - published:+g})")
@@ -1,12 +1,36 @@
+import concurrent.futures
+import gzip
+import json
+import math
+import multiprocessing
+import os
 import uuid
 import pytest
 import random
+import itertools
+import threading
+import time
+from pathlib import Path
+from concurrent.futures.process import BrokenProcessPool
 
+from django.core.management import call_command
 from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
 from rest_framework.authtoken.models import Token
-from .models import Team, Map, Game, Stage, Score
+from . import models
+from .models import Team, Map, Game, Stage, Score, Deal
+from .maputils import Map as MapUtils
+from . import bruteforce_solve
+from . import standings
+from .solutions import SolutionStore, SolveResult
+
+viewer_maps_dir = Path(__file__).resolve().parents[2] / 'web_viewer' / 'maps'
+
+@pytest.fixture(autouse=True)
+def solution_store(settings, tmp_path):
+    settings.SOLUTION_STORE = tmp_path / 'solutions.sqlite3'
+    return settings.SOLUTION_STORE
 
 @pytest.fixture
 def test_password():
@@ -80,6 +104,75 @@ class TestMapSubmission:
         assert db_map.map_data == simple_map_str
         assert db_map.proposed_by == token.user
 
+    def test_new_map_live_scores(self, api_client, get_or_create_token, simple_map_str, stage_running, create_user):
+        token = get_or_create_token
+        Team(user=token.user).save()
+        other = create_user()
+        Team(user=other).save()
+        stage_running.number_of_maps = 2
+        stage_running.save()
+        def stale():
+            return Team.stale_scores(list(Team.objects.all()))
+        assert stale() == [] and Team.objects.get(user=token.user).score_game == 20
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        response = api_client.post(f'/api/map/new/{stage_running.endpoint}', {'map': simple_map_str})
+        assert response.status_code == 200
+        assert stale() == [] and Team.objects.get(user=token.user).score_game == 10
+
+        # Writes of the admin
+        m = Map.objects.get(proposed_by=token.user)
+        game = Game(map=m, player=other, stage=stage_running, moves='X', finished=True, victory=True, reference_score=3)
+        game.save()
+        Score(game=game, referee=token.user, score=4).save()
+        stage_running.number_of_maps = 3
+        stage_running.save()
+        assert stale() == []
+        Score.objects.all().delete()
+        assert stale() == []
+        Score(game=game, referee=token.user, score=4).save()
+        game.delete()
+        assert stale() == []
+        Game(map=m, player=other, stage=stage_running, moves='X').save()
+        stage_running.maps.remove(m)
+        assert stale() == []
+        m.stage_set.add(stage_running)
+        assert stale() == []
+        stage_running.maps.clear()
+        assert stale() == []
+        stage_running.maps.add(m)
+        m.delete()
+        assert stale() == []
+        Stage.objects.filter(pk=stage_running.pk).delete()
+        assert stale() == [] and Team.objects.get(user=token.user).score_game == 0
+
+    @pytest.mark.parametrize('time_budget, impossible', [(60, False), (0, None)])
+    def test_new_map_solvability(self, api_client, get_or_create_token, simple_map_str, settings,
+                                 django_capture_on_commit_callbacks, time_budget, impossible):
+        settings.MAP_SOLVER_WORKERS, settings.MAP_SOLVER_TIME_BUDGET = 0, time_budget
+        token = get_or_create_token
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.post('/api/map/new', {'map': simple_map_str})
+        assert response.status_code == 200
+        db_map = Map.objects.all().last()
+        assert db_map.impossible == impossible
+        if impossible is None:
+            assert db_map.optimal_moves is None
+        else:
+            assert db_map.optimal_moves == pytest.approx(bruteforce_solve.astar_solve(MapUtils(simple_map_str))[1])
+
+    def test_broken_solver_pool(self, simple_map_str, settings, monkeypatch):
+        settings.MAP_SOLVER_WORKERS = 1
+        pool = concurrent.futures.ProcessPoolExecutor(1, multiprocessing.get_context('spawn'))
+        with pytest.raises(BrokenProcessPool):
+            pool.submit(os._exit, 1).result()
+        monkeypatch.setattr(models, 'solver_pool', pool)
+        searched = threading.Event()
+        models.submit_solver((simple_map_str, 60, None), lambda future: searched.set())
+        # A new pool took over from the broken one
+        assert searched.wait(60) and models.solver_pool is not pool
+        models.solver_pool.shutdown()
+
     def test_new_map_no_arrival(self, api_client, get_or_create_token, invalid_map_str_no_arrival):
         token = get_or_create_token
         api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
@@ -213,6 +306,33 @@ class TestGameRequestMechanics:
         response = api_client.get(f'/api/game/new/{stage_with_map.endpoint}')
         assert response.status_code == 402, response.data
 
+    def test_new_game_stage_deals(self, api_client, get_or_create_token, stage_with_map, django_assert_max_num_queries):
+        for i in range(4):
+            m = Map(map_data=self.the_map.map_data, proposed_by=self.user)
+            m.save()
+            stage_with_map.maps.add(m)
+        token = get_or_create_token
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        # The maps left are dealt by the first request
+        assert api_client.get(f'/api/game/new/{stage_with_map.endpoint}').status_code == 200
+        assert Deal.objects.filter(player=token.user).count() == 4
+        # A map removed from the stage once dealt is skipped
+        stage_with_map.maps.remove(Deal.objects.filter(player=token.user).first().map)
+        for i in range(3):
+            with django_assert_max_num_queries(20):
+                response = api_client.get(f'/api/game/new/{stage_with_map.endpoint}')
+            assert response.status_code == 200, response.data
+        played = list(Game.objects.filter(player=token.user).values_list('map', flat=True))
+        assert sorted(played) == sorted(stage_with_map.maps.values_list('id', flat=True))
+        response = api_client.get(f'/api/game/new/{stage_with_map.endpoint}')
+        assert response.status_code == 402, response.data
+
+        # Dev stages deal their maps again once played
+        stage_with_map.dev = True
+        stage_with_map.save()
+        assert api_client.get(f'/api/game/new/{stage_with_map.endpoint}').status_code == 200
+        assert Game.objects.filter(player=token.user).count() == 5
+
 class TestPlayMechanics:
     @pytest.fixture
     def setup_maps(self, create_user):
@@ -335,6 +455,18 @@ ACC -1 0 0"""
         assert response.status_code == 403, response.data
         assert response.data['message'] == 'This game has already been played'
 
+    def test_analysis_timeout(self, api_client, setup_game_firstmap, first_map_solution, settings):
+        token = Token.objects.get(user=self.player_user)
+        api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        settings.PATH_TIME_BUDGET = 0
+        response = api_client.post(f'/api/game/{self.game.id}/solve', {'moves': first_map_solution})
+        assert response.status_code == 503, response.data
+        db_game = Game.objects.get(pk=self.game.id)
+        assert not db_game.finished and db_game.reference_score is None
+        settings.PATH_TIME_BUDGET = 5
+        response = api_client.post(f'/api/game/{self.game.id}/solve', {'moves': first_map_solution})
+        assert response.status_code == 200 and response.data['victory']
+
     def test_inexistent_game(self, api_client, setup_game_firstmap, first_map_solution):
         token = Token.objects.get(user=self.player_user)
         api_client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
@@ -680,6 +812,146 @@ class TestTeamScoreComputation:
         assert team1.score_game == 4
         assert team2.score_game == 3
 
+class TestScoreEngine:
+    def test_player_scores(self, create_user, django_assert_num_queries):
+        user1, user2, user3 = create_user(), create_user(), create_user()
+        team1, team2 = Team(user=user1), Team(user=user2)
+        team1.save()
+        team2.save()
+        stage, dev = Stage(endpoint='test_scoring'), Stage(endpoint='test_dev', dev=True)
+        stage.save()
+        dev.save()
+        maps = {name: Map(map_data='', proposed_by=user3) for name in 'ABCD'}
+        for m in maps.values():
+            m.save()
+            stage.maps.add(m)
+        dev.maps.add(maps['A'])
+
+        def play(user, name, reference_score, victory=True, s=stage, **kwargs):
+            Game(map=maps[name], player=user, stage=s, finished=True, victory=victory,
+                 reference_score=reference_score, **kwargs).save()
+        play(user2, 'A', 10, completed_at=timezone.now() - timedelta(hours=1))
+        play(user1, 'A', 3)
+        play(user2, 'A', 5)
+        play(user1, 'A', 100, s=dev)
+        play(user2, 'B', 4)
+        play(user3, 'B', 6)
+        play(user1, 'B', 2, victory=False)
+        play(user2, 'C', 1, victory=False)
+        play(user2, 'D', 7)
+
+        with django_assert_num_queries(3):
+            scores = models.player_scores([user1.id, user2.id])
+        # A: best 3, user2's latest game counts. B: user1 lost, 2-4 + 2*(6-4).
+        # C: nobody won. D: user1 did not play, 10*7.
+        assert scores == {user1.id: 0 + 2 + 0 + 70, user2.id: 2 + 0 + 0 + 0}
+
+        Team.update_scores([team1, team2])
+        assert Team.objects.get(pk=team1.pk).score_player == 72
+        assert Team.objects.get(pk=team2.pk).score_player == team2.compute_score_player() == 2
+
+    def test_player_scores_stage_closed(self, create_user):
+        user1, user2 = create_user(), create_user()
+        team1, team2 = Team(user=user1), Team(user=user2)
+        team1.save()
+        team2.save()
+        stage = Stage(endpoint='test_closed', running=True)
+        stage.save()
+        m = Map(map_data='', proposed_by=user1)
+        m.save()
+        stage.maps.add(m)
+        Game(map=m, player=user1, stage=stage, finished=True, victory=True, reference_score=4).save()
+        Game(map=m, player=user2, stage=stage).save()
+        stage.running = False
+        stage.save()
+        # The game of user2 was closed unplayed, with no reference score
+        assert Game.objects.get(player=user2).reference_score is None
+        Team.update_scores([team1, team2])
+        assert (team1.score_player, team2.score_player) == (0, 40)
+
+    def test_live_scores(self, create_user):
+        users = [create_user() for i in range(3)]
+        teams = [Team(user=user) for user in users]
+        for team in teams:
+            team.save()
+        stage = Stage(endpoint='test_live', running=True, number_of_maps=2)
+        stage.save()
+        maps = [Map(map_data='', proposed_by=users[i % 2]) for i in range(3)]
+        for m in maps:
+            m.save()
+            stage.maps.add(m)
+        Team.update_scores(teams)
+
+        def saved():
+            return {team.user_id: (team.score_player, team.score_game) for team in Team.objects.all()}
+        def game(user, m, moves='', **kwargs):
+            g = Game(map=maps[m], player=users[user], stage=stage, moves=moves, **kwargs)
+            g.save()
+            return g
+        def play(g, reference_score, victory=True):
+            g.moves, g.finished, g.victory, g.reference_score = 'X', True, victory, reference_score
+            g.save()
+
+        games = [game(0, 1), game(1, 0), game(2, 0), game(2, 1)]
+        assert Team.stale_scores(list(Team.objects.all())) == []
+        play(games[0], 5)
+        play(games[1], 3)
+        before = saved()
+        play(games[2], 8, victory=False)
+        # Only the player scores of the map and its proposer's score changed
+        after = saved()
+        assert Team.stale_scores(list(Team.objects.all())) == []
+        assert after[users[1].id][1] == before[users[1].id][1]
+        assert after[users[0].id][1] != before[users[0].id][1]
+        assert after[users[2].id][0] != before[users[2].id][0]
+        play(games[3], 2)
+        game(1, 2, finished=True, victory=True, reference_score=4)
+        Score(game=games[1], referee=users[0], score=3).save()
+        Score(game=games[2], referee=users[0], score=5).save()
+        Score(game=games[3], referee=users[1], score=2).save()
+        assert Team.stale_scores(list(Team.objects.all())) == []
+        # Scores in sixths and ninths add up with rounding errors
+        rng = random.Random(1)
+        for i in range(40):
+            play(game(i % 3, i % 3), rng.randrange(1, 60) / rng.choice((6, 9)), victory=rng.random() < 0.7)
+        assert Team.stale_scores(list(Team.objects.all())) == []
+        # A background proof that a map can't be won
+        before = saved()
+        maps[2].record_solution(SolveResult([], None, math.inf, True, 0))
+        assert saved()[users[0].id][1] == before[users[0].id][1] + 20*Game.objects.filter(map=maps[2]).count()
+        assert Team.stale_scores(list(Team.objects.all())) == []
+        stage.running = False
+        stage.save()
+        assert Team.stale_scores(list(Team.objects.all())) == []
+
+    def test_game_scores_fixture(self, db, django_assert_num_queries):
+        call_command('loaddata', str(Path(__file__).resolve().parents[1] / 'db.json.xz'))
+        users = list(Team.objects.values_list('user_id', flat=True))
+        with django_assert_num_queries(4):
+            scores = models.game_scores(users)
+        # As computed by the previous per stage and per map loops
+        assert scores == {4: 220, 5: 518, 6: 514, 7: 130, 8: 1217, 9: 684, 10: 199, 11: 461}
+
+    def test_standings(self, db, tmp_path):
+        dump = Path(__file__).resolve().parents[1] / 'db.json.xz'
+        event = standings.Event.load(dump)
+        call_command('loaddata', str(dump))
+        users = list(Team.objects.values_list('user_id', flat=True))
+        assert event.player_scores() == pytest.approx(models.player_scores(users))
+        assert event.game_scores() == models.game_scores(users)
+
+        # A streaming export, one record per line
+        lines = tmp_path / 'db.ndjson'
+        lines.write_text(''.join(json.dumps(r) + '\n' for r in standings.records(dump)))
+        assert standings.Event.load(lines).game_scores() == event.game_scores()
+
+        rows = event.standings(standings.Rules(unplayed=0, impossible=0))
+        totals = [r.player + r.game for r in rows]
+        assert totals == sorted(totals) and sorted(r.user for r in rows) == sorted(users)
+        assert all(r.player <= event.player_scores()[r.user] for r in rows)
+        team = Team.objects.get(user_id=rows[0].user)
+        assert (rows[0].published_player, rows[0].published_game) == (team.score_player, team.score_game)
+
 class TestStageMechanics:
 
     def test_unfinished_games_upon_stage_end(self, create_user):
@@ -706,3 +978,338 @@ class TestStageMechanics:
         assert Game.objects.get(pk=g2.pk).finished
         assert Game.objects.get(pk=g1.pk).victory == False
         assert Game.objects.get(pk=g2.pk).victory == False
+
+    def test_impossible_from_store(self, create_user, simple_map_str, solution_store):
+        user = create_user()
+        won, lost = (Map(map_data=simple_map_str + '\n' * n, proposed_by=user) for n in (0, 1))
+        won.save()
+        lost.save()
+        s = Stage(endpoint='test', running=True)
+        s.save()
+        s.maps.add(won, lost)
+        with SolutionStore(solution_store) as store:
+            store.solve(MapUtils(won.map_data), bruteforce_solve.anytime_solve)
+
+        # Nobody won, but the stored search proves both maps can be won
+        s.running = False
+        s.save()
+        assert Map.objects.get(pk=won.pk).impossible == False
+        assert Map.objects.get(pk=lost.pk).impossible == False
+
+class TestMapAnalysis:
+
+    @pytest.mark.parametrize('name', sorted(p.stem for p in viewer_maps_dir.glob('*.path')))
+    def test_viewer_paths(self, name):
+        m = MapUtils((viewer_maps_dir / f'{name}.map').read_text())
+        assert m.valid
+        result = m.analyze_path((viewer_maps_dir / f'{name}.path').read_text())
+        _, ok, score = (viewer_maps_dir / f'{name}.log').read_text().splitlines()[-1].split()
+        assert result.ok == (ok == 'OK')
+        assert result.moves == pytest.approx(float(score), abs=1e-5)
+
+    def test_block_tables(self):
+        for code in range(0x8000):
+            block = MapUtils.code_b64(code)
+            assert MapUtils.block_code(block) == code
+            info = MapUtils.decode_block(block)
+            assert MapUtils.block_to_b64(info.bt.value - 1, *info[1:7]) == block
+            assert MapUtils.decode_code(code)[:7] == info[:7]
+        assert MapUtils.decode_block('BAA') is MapUtils.decode_block('BAA')
+        assert MapUtils.decode_code(0x1000) is MapUtils.decode_code(0x1000)
+        with pytest.raises(ValueError):
+            MapUtils.block_code('A!A')
+
+    @pytest.mark.parametrize('mapdesc, error', [
+        ('MAP 1 1\nB//\nENDMAP\nSTART 0 0 0\n', "line 1, column 1: expected 'MAP Nx Ny Nz'"),
+        ('MAP 1 1 1\nB/!\nENDMAP\nSTART 0 0 0\n', "line 2, column 3: invalid character '!'"),
+        ('MAP 1 1 1\nB//\nENDMAP\nSTART 0 0\n', "line 3, column 1: expected 'START Sx Sy Sz' after 'ENDMAP'"),
+        ('MAP 1 1 1\nB//\n', "missing 'ENDMAP'"),
+    ])
+    def test_parse_error(self, mapdesc, error):
+        assert MapUtils(mapdesc).find_error() == f'Invalid global structure ({error})'
+
+    def test_parse_unseparated_blocks(self):
+        m = MapUtils('\n\nMAP 3 1 1\nAAAB\n/ /AA\nA\nENDMAP\n\nSTART 0 0 0\nignored')
+        assert (m.Nx, m.Ny, m.Nz, m.Sx, m.Sy, m.Sz) == (3, 1, 1, 0, 0, 0)
+        assert list(m.grid) == [0, MapUtils.outside_code, 0]
+
+    def test_out_of_the_universe(self):
+        m = MapUtils('MAP 3 1 1\nAAA AAA A//\nENDMAP\nSTART 0 0 0')
+        result = m.analyze_path_step(m.startstate, -1, 0, 0)
+        assert result == MapUtils.PathAnalysis(False, 0.5, 'Out of the universe')
+
+    @pytest.mark.parametrize('asteroid, expected', [
+        ('B//', MapUtils.PathAnalysis(False, 0.25, 'Collision')),
+        ('BVV', MapUtils.PathAnalysis(True, 0.75, 'Victory')),
+    ])
+    def test_diagonal_move_along_asteroid_corner(self, asteroid, expected):
+        m = MapUtils(f'MAP 3 3 1\nAAA {asteroid} AAA\nAAA AAA AAA\nAAA AAA A//\nENDMAP\nSTART 0 0 0')
+        state = MapUtils.State(0, 0, 0, 1, 1, 0, 0)
+        assert m.analyze_path_step(state, 1, 1, 0) == expected
+
+    def test_transition_cache(self):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        path = (viewer_maps_dir / 'game1.path').read_text()
+        expected = m.analyze_path(path)
+        m.enable_transition_cache(maxsize=128)
+        assert m.analyze_path(path) == expected
+        assert m.analyze_path(path) == expected
+        info = m.transition_cache.cache_info()
+        assert info.misses == len(path.splitlines())
+        assert info.hits == info.misses
+
+    def test_successors(self):
+        m = MapUtils((viewer_maps_dir / 'training3.map').read_text())
+        for state in (m.startstate, MapUtils.State(3, 1, 1, 2, 0, 1, 0), MapUtils.State(5, 3, 2, 1, -1, 0, 0)):
+            successors = dict(m.successors(state))
+            for a in MapUtils.accelerations:
+                result = m.analyze_path_step(state, *a)
+                if a in successors:
+                    assert successors[a] == result
+                else:
+                    assert result.msg == 'Invalid acceleration in nebula'
+
+    def test_streamed_path(self):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        path = (viewer_maps_dir / 'game1.path').read_text()
+        with open(viewer_maps_dir / 'game1.path') as f:
+            assert m.analyze_path(f) == m.analyze_path(path)
+        assert m.analyze_path(iter(path.splitlines(keepends=True))) == m.analyze_path(path)
+
+    def test_bounded_path(self):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        path = (viewer_maps_dir / 'game1.path').read_text()
+        lines = len(path.splitlines())
+        assert m.analyze_path(path, max_moves=lines).ok
+        assert m.analyze_path(path, max_moves=lines-1) == (False, lines-1, 'Too many moves')
+        assert m.analyze_path(path, time_budget=0) == (False, 0, 'Analysis time budget exceeded')
+        assert m.analyze_path(itertools.repeat('ACC 0 0 0\n'), max_moves=100) == (False, 100, 'Too many moves')
+
+    def test_clearance(self):
+        m = MapUtils('MAP 6 1 1\nAAA AAA AAA B// AAA AAA\nENDMAP\nSTART 0 0 0')
+        assert m.clearance(0, 0, 0, 1, 0, 0) == 2
+        assert m.clearance(5, 0, 0, -1, 0, 0) == 1
+        assert m.clearance(4, 0, 0, 1, 0, 0) == 1
+        assert m.clearance(0, 0, 0, 1, 1, 0) == 0
+        assert m.analyze_path_step(MapUtils.State(0, 0, 0, 2, 0, 0, 0), 1, 0, 0) == (False, 15/18, 'Collision')
+        assert m.analyze_path_step(MapUtils.State(4, 0, 0, 1, 0, 0, 0), 1, 0, 0) == (False, 9/12, 'Out of the universe')
+
+    def test_occupancy(self):
+        m = MapUtils((viewer_maps_dir / 'training2.map').read_text())
+        assert m.occupied(0, m.Nx-1, 0, m.Ny-1, 0, m.Nz-1) == sum(not b.empty for b in m)
+        assert m.occupied(3, 3, 1, 2, 1, 2) == 4
+        assert m.occupied(0, 2, 0, 3, 0, 2) == 0
+
+    def test_envelope(self):
+        m = MapUtils('MAP 6 1 1\nAAA AAA A// AAA AAA AAA\nENDMAP\nSTART 0 0 0')
+        lo, hi, down, up = m.envelope[0]
+        assert list(hi) == [2, 2, 2, 1, 1, 0] and list(lo) == [0, -1, -1, -2, -2, -2]
+        assert m.doomed(0, 0, 0, -1, 0, 0, 0)
+        assert not m.doomed(0, 0, 0, 3, 0, 0, 0) # Leaves, but touches the goal on the way
+        assert m.doomed(3, 0, 0, 2, 0, 0, 0) and not m.doomed(3, 0, 0, -3, 0, 0, 0)
+
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        for state in [m.startstate, MapUtils.State(2, 5, 1, 3, -2, 0, 0), MapUtils.State(0, 0, 0, -3, -3, 3, 0)]:
+            pruned = m.successors(state, prune=True)
+            assert all(result in pruned for result in m.successors(state) if not m.doomed(
+                state.Px, state.Py, state.Pz, state.Vx + result[0][0], state.Vy + result[0][1], state.Vz + result[0][2], 0))
+            assert not any(isinstance(result, MapUtils.PathAnalysis) and result.ok
+                           for A, result in m.successors(state) if (A, result) not in pruned)
+
+class TestSolver:
+
+    @pytest.mark.parametrize('name, moves', [
+        ('exemple', 23/9), ('tests', 7.25), ('game1', 35/6), ('training2', 3.25), ('training3', 19/6),
+    ])
+    def test_astar(self, name, moves):
+        m = MapUtils((viewer_maps_dir / f'{name}.map').read_text())
+        path, found = bruteforce_solve.astar_solve(m)
+        assert found == pytest.approx(moves)
+        result = m.analyze_path(''.join(f'ACC {Ax} {Ay} {Az}\n' for Ax, Ay, Az in path))
+        assert result.ok and result.moves == found
+
+    @pytest.mark.parametrize('name', ['tests', 'game1'])
+    def test_astar_jobs(self, name):
+        m = MapUtils((viewer_maps_dir / f'{name}.map').read_text())
+        path, moves = bruteforce_solve.astar_solve(m, jobs=2, batch_size=16)
+        assert moves == bruteforce_solve.astar_solve(m)[1]
+        assert m.analyze_path(''.join(f'ACC {Ax} {Ay} {Az}\n' for Ax, Ay, Az in path)) == (True, moves, 'Victory')
+
+    def test_anytime(self):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        progress = []
+        result = bruteforce_solve.anytime_solve(m, callback=progress.append, report_every=16)
+        assert result.optimal and result.moves == pytest.approx(35/6)
+        assert result.lower_bound == result.moves
+        assert progress and all(p.lower_bound <= result.moves and p.memory > 0 for p in progress)
+        assert progress[-1].moves == result.moves
+
+        partial = bruteforce_solve.anytime_solve(m, max_nodes=result.nodes // 4)
+        assert not partial.optimal and partial.nodes == result.nodes // 4
+        assert 0 < partial.lower_bound <= result.moves
+
+        cancel = threading.Event()
+        cancel.set()
+        cancelled = bruteforce_solve.anytime_solve(m, cancel=cancel)
+        assert cancelled.nodes == 0 and cancelled.path == [] and cancelled.moves is None
+        assert bruteforce_solve.anytime_solve(m, time_budget=0).nodes == 0
+
+    @pytest.mark.parametrize('name', ['tests', 'training2', 'training3'])
+    def test_astar_optimal(self, name, monkeypatch):
+        m = MapUtils((viewer_maps_dir / f'{name}.map').read_text())
+        _, moves = bruteforce_solve.astar_solve(m)
+        monkeypatch.setattr(bruteforce_solve, 'kinematic_bound', lambda m: lambda state: 0)
+        assert bruteforce_solve.astar_solve(m)[1] == pytest.approx(moves)
+
+    def test_state_table(self):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        space = bruteforce_solve.StateSpace(m)
+        table = bruteforce_solve.StateTable(capacity=4)
+        states = [MapUtils.State(Px, Py, 4, Vx, -7, 4, 0) for Px in range(10) for Py in range(8) for Vx in (-9, 0, 9)]
+        for n, state in enumerate(states):
+            index = space.pack(state)
+            assert 0 <= index < space.size and space.unpack(index) == state
+            table[index] = n
+        assert table.count == len(states) and len(table.keys) >= 2 * len(states)
+        assert [table.get(space.pack(state)) for state in states] == list(range(len(states)))
+        assert table.get(space.pack(MapUtils.State(0, 0, 0, 0, 0, 0, 0))) is None
+
+    def test_bruteforce(self):
+        m = MapUtils((viewer_maps_dir / 'training2.map').read_text())
+        path, moves = bruteforce_solve.bruteforce_solve(m)
+        assert m.analyze_path(''.join(f'ACC {Ax} {Ay} {Az}\n' for Ax, Ay, Az in path)) == (True, moves, 'Victory')
+
+    def test_kinematic_bound(self):
+        m = MapUtils('MAP 5 1 1\nAAA AAA AAA AAA A//\nENDMAP\nSTART 0 0 0')
+        estimate = bruteforce_solve.kinematic_bound(m)
+        # Moves of 1 and 2 cells, then half a cell at speed 3 to touch the goal
+        assert estimate(m.startstate) == pytest.approx(2 + 1/6, abs=1e-6)
+        assert bruteforce_solve.astar_solve(m)[1] == pytest.approx(2 + 1/6)
+        assert estimate(MapUtils.State(0, 0, 0, -4, 0, 0, 0)) is None
+
+    @pytest.mark.parametrize('name', ['tests', 'game1', 'training2', 'training3', 'training5'])
+    def test_staged(self, name):
+        m = MapUtils((viewer_maps_dir / f'{name}.map').read_text())
+        _, moves = bruteforce_solve.astar_solve(m)
+        path, found = bruteforce_solve.astar_solve(m, staged=True)
+        assert found == pytest.approx(moves)
+        assert m.analyze_path(''.join(f'ACC {Ax} {Ay} {Az}\n' for Ax, Ay, Az in path)) == (True, found, 'Victory')
+
+        weighted = bruteforce_solve.anytime_solve(m, staged=True, weight=1.5)
+        assert moves - 1e-6 <= weighted.moves <= 1.5 * moves + 1e-6
+        assert weighted.lower_bound <= moves + 1e-6 and not weighted.optimal
+
+    def test_staged_bound(self):
+        # A wall with a hole at the far end: the ship goes up and back
+        m = MapUtils('MAP 5 3 1\nAAA AAA AAA AAA AAA\nB// B// B// B// AAA\nA// AAA AAA AAA AAA\nENDMAP\nSTART 0 0 0')
+        assert bruteforce_solve.cell_distances(m)[0][0] == 8
+        estimate = bruteforce_solve.staged_bound(m)
+        assert estimate(m.startstate) > bruteforce_solve.kinematic_bound(m)(m.startstate)
+        assert estimate(m.startstate) <= bruteforce_solve.astar_solve(m)[1]
+        # An open map, each cell reached through many neighbours
+        N = 12
+        blocks = ['AAA'] * N**3
+        blocks[-1] = 'A//'
+        m = MapUtils(f'MAP {N} {N} {N}\n' + '\n'.join(' '.join(blocks[i:i+N]) for i in range(0, N**3, N))
+                     + '\nENDMAP\nSTART 0 0 0')
+        start = time.monotonic()
+        field = bruteforce_solve.cell_distances(m)[0]
+        assert time.monotonic() - start < 5
+        assert field[0] == N - 1 and field[N - 1] == N - 1 and field[-1] == 0
+        assert bruteforce_solve.travel_moves(3, 0) == 2
+        assert bruteforce_solve.travel_moves(4, 0) == pytest.approx(2 + 1/3)
+
+    def test_batch(self, tmp_path):
+        (tmp_path / 'a.map').write_text((viewer_maps_dir / 'training2.map').read_text())
+        with gzip.open(tmp_path / '1.txt.gz', 'wt') as f:
+            f.write((viewer_maps_dir / 'exemple.map').read_text() + '\nACC 0 0 0\n\nEND NOK 1\n')
+        (tmp_path / 'b.map').write_text('MAP 1 1 1\nENDMAP\nSTART 0 0 0')
+        filenames = bruteforce_solve.map_files([str(tmp_path)])
+        assert [Path(f).name for f in filenames] == ['1.txt.gz', 'a.map', 'b.map']
+        records = {Path(r['map']).name: r for r in bruteforce_solve.batch_solve(filenames, jobs=2)}
+        assert records['a.map']['moves'] == pytest.approx(3.25) and records['a.map']['optimal']
+        assert records['1.txt.gz']['moves'] == pytest.approx(23/9) and records['1.txt.gz']['path']
+        assert records['b.map']['error'] and records['b.map']['invalid'] and records['b.map']['moves'] is None
+
+        # Maps the run ran out of time or memory on are searched again
+        output = tmp_path / 'solved.ndjson'
+        records['1.txt.gz'].update(moves=None, optimal=False, path=[], error="Out of memory")
+        records['c.map'] = dict(records['a.map'], map=str(tmp_path / 'c.map'), optimal=False)
+        output.write_text(''.join(json.dumps(r) + '\n' for r in records.values()))
+        assert bruteforce_solve.solved_files(output) == {filenames[1], filenames[2]}
+
+    def test_store(self, tmp_path, monkeypatch):
+        text = (viewer_maps_dir / 'training2.map').read_text()
+        m = MapUtils(text)
+        header, blocks = text.split('\n', 1)
+        blocks, footer = blocks.rsplit('\nENDMAP', 1)
+        assert MapUtils(header + '\n' + blocks.replace(' ', '\n') + '\n\nENDMAP' + footer).digest() == m.digest()
+        assert MapUtils(text.replace('START 0', 'START 1')).digest() != m.digest()
+
+        with SolutionStore(tmp_path / 'store') as store:
+            assert store.get(m) is None
+            partial = store.solve(m, bruteforce_solve.anytime_solve, max_nodes=1)
+            assert not partial.optimal and store.get(m) == partial
+            result = store.solve(m, bruteforce_solve.anytime_solve, staged=True)
+            assert result.optimal and store.get(m) == result
+            assert bruteforce_solve.astar_solve(m, store=store) == (result.path, result.moves)
+            store.put(m, partial)
+            assert store.get(m) == result
+
+        monkeypatch.setattr(MapUtils, 'engine_version', MapUtils.engine_version + 1)
+        with SolutionStore(tmp_path / 'store') as store:
+            assert store.get(m) is None
+
+    def test_frontier(self, tmp_path):
+        entries = random.Random(1).sample(range(1 << 40), 1000)
+        frontier = bruteforce_solve.Frontier(5, limit=64, directory=tmp_path)
+        for e in entries[:600]:
+            frontier.push(e)
+        assert frontier.runs and len(frontier) == 600
+        popped = [frontier.pop() for _ in range(100)]
+        for e in entries[600:]:
+            frontier.push(e)
+        saved = tmp_path / 'frontier'
+        with open(saved, 'wb') as f:
+            frontier.save(f)
+        copy = bruteforce_solve.Frontier(5)
+        with open(saved, 'rb') as f:
+            copy.load(f, len(frontier))
+        assert popped == sorted(entries[:600])[:100]
+        rest = sorted(set(entries) - set(popped))
+        assert [frontier.pop() for _ in range(len(frontier))] == rest
+        assert [copy.pop() for _ in range(len(copy))] == rest
+        assert not frontier and not copy
+
+    def test_spill(self, tmp_path):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        result = bruteforce_solve.anytime_solve(m)
+        spilled = bruteforce_solve.anytime_solve(m, max_memory=1 << 16, spill_dir=tmp_path)
+        assert spilled == result and not list(tmp_path.iterdir())
+
+        table = bruteforce_solve.StateTable(capacity=4).spill(tmp_path)
+        for key in range(100):
+            table[key * 7] = key
+        assert [table.get(key * 7) for key in range(100)] == list(range(100)) and table.get(1) is None
+        table.close()
+        assert not list(tmp_path.iterdir())
+
+    def test_checkpoint(self, tmp_path):
+        m = MapUtils((viewer_maps_dir / 'game1.map').read_text())
+        result = bruteforce_solve.anytime_solve(m)
+        checkpoint = str(tmp_path / 'search')
+        partial = bruteforce_solve.anytime_solve(m, max_nodes=result.nodes // 2, checkpoint_file=checkpoint)
+        assert not partial.optimal
+        resumed = bruteforce_solve.anytime_solve(m, checkpoint_file=checkpoint)
+        assert resumed == result
+        # Resumed past the memory ceiling, with the table mapped and the frontier bounded
+        large = MapUtils((viewer_maps_dir / 'random1.map').read_text())
+        bounded = str(tmp_path / 'bounded')
+        bruteforce_solve.anytime_solve(large, max_nodes=2000, checkpoint_file=bounded)
+        progress = []
+        bruteforce_solve.anytime_solve(large, max_nodes=4000, checkpoint_file=bounded, max_memory=1 << 16,
+                                       spill_dir=tmp_path, callback=progress.append, report_every=100)
+        assert max(p.frontier for p in progress) > 1024 and max(p.memory for p in progress) <= 1 << 16
+        # Another search of the map starts over
+        weighted = bruteforce_solve.anytime_solve(m, weight=2, max_nodes=1, checkpoint_file=checkpoint)
+        assert weighted.nodes == 1
@@ -1,3 +1,7 @@
+import random
+
+from django.db import transaction
+from django.db.models import Max
 from django.http import HttpResponse
 from django.shortcuts import render
 from django.utils import timezone
@@ -9,7 +13,7 @@ from rest_framework import status
 from rest_framework import authentication, permissions
 from django.contrib.auth.models import User
 
-from .models import Map, Game, Stage, Team, Score
+from .models import Map, Game, Stage, Team, Score, Deal, AnalysisTimeout, prove_solvability
 
 def index(request):
     teams = Team.objects.all()
@@ -88,6 +92,7 @@ class NewMapView(APIView):
         valid_map, errors = map_obj.validate()
         if valid_map:
             map_obj.save()
+            prove_solvability(map_obj)
 
             if stage_endpoint is not None:
                 stage.maps.add(map_obj)
@@ -115,24 +120,24 @@ class NewGameView(APIView):
                     {'status': 'error', 'message': f'Stage {stage_endpoint} is not running'},
                     status=status.HTTP_403_FORBIDDEN
                 )
-            played_maps = set(Game.objects.filter(player=request.user, stage=stage).values_list('map', flat=True))
-            all_maps_from_stage = set(stage.maps.values_list('id', flat=True))
-            remaining_maps = all_maps_from_stage.difference(played_maps)
-            if not stage.dev and not remaining_maps:
-                return Response(
-                    {'status': 'error', 'message': 'No more maps to play'},
-                    status=status.HTTP_402_PAYMENT_REQUIRED
+            with transaction.atomic():
+                proposed_map = Deal.next_map(stage, request.user)
+                if proposed_map is None:
+                    return Response(
+                        {'status': 'error', 'message': 'No more maps to play'},
+                        status=status.HTTP_402_PAYMENT_REQUIRED
+                    )
+                game = Game(
+                    map=proposed_map,
+                    stage=stage,
+                    player=request.user
                 )
-            proposed_map = Map.objects.filter(id__in=remaining_maps).order_by('?').first()
-            game = Game(
-                map=proposed_map,
-                stage=stage,
-                player=request.user
-            )
-            game.save()
+                game.save()
 
         else:
-            proposed_map = Map.objects.order_by('?').first()
+            # A map from a random id rather than sorting them all at random
+            last = Map.objects.aggregate(last=Max('pk'))['last'] or 0
+            proposed_map = Map.objects.filter(pk__gte=random.randint(0, last)).order_by('pk').first()
             game = Game(
                 map=proposed_map,
                 player=request.user
@@ -172,7 +177,13 @@ class ProposeSolutionView(APIView):
             )
         game.moves = moves
         game.finished = True
-        game.save()
+        try:
+            game.save()
+        except AnalysisTimeout:
+            return Response(
+                {'status': 'error', 'message': 'The server is too busy to analyze these moves, try again later'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         return Response({'status': 'success', 'reference_score': game.reference_score,
                          'message': game.analysis_message, 'victory': game.victory})
 
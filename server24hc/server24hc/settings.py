@@ -155,3 +155,21 @@ REST_FRAMEWORK = {
         'user': '10/second'
     }
 }
+
+# Bounds on the analysis of a submitted path, so that a huge submission cannot
+# tie up a worker: games whose moves go over PATH_MAX_MOVES are scored as
+# failed, submissions whose analysis goes over PATH_TIME_BUDGET are rejected.
+PATH_MAX_MOVES = 10000
+PATH_TIME_BUDGET = 5 # Seconds of CPU time of the request thread
+
+# Solver results shared with the solver command line (--store), looked up to
+# tell whether a map can be won. None to go without.
+SOLUTION_STORE = BASE_DIR / 'solutions.sqlite3'
+
+# Background search of each submitted map, recording on its row whether it
+# can be won, before games are played on it. 0 workers to search during the
+# submission request. The workers, of up to MAP_SOLVER_MAX_MEMORY each, are
+# started by every process of the web server that receives a map.
+MAP_SOLVER_WORKERS = 1
+MAP_SOLVER_TIME_BUDGET = 60 # Seconds of wall clock time a map
+MAP_SOLVER_MAX_MEMORY = 2 << 30 # Bytes of address space a worker
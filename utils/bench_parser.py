@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""Compare the map parser with the regular expression based one it replaced,
+over the maps of the postmortem games."""
+
+import argparse
+import gzip
+import re
+import time
+from array import array
+from pathlib import Path
+
+from map import Map
+
+mapdesc_pattern = re.compile(r"^\n*MAP (\d+) (\d+) (\d+)\n+([a-zA-Z0-9+/\n\s]+)\n+ENDMAP\n+START (\d+) (\d+) (\d+)\n*$", re.MULTILINE)
+
+def regex_parse(mapdesc):
+    m = mapdesc_pattern.match(mapdesc)
+    if not m: return (0,)*6, array('H')
+    Nx, Ny, Nz, data, Sx, Sy, Sz = m.groups()
+    blocks = re.findall('...', ''.join(data.split()))
+    return tuple(map(int, (Nx, Ny, Nz, Sx, Sy, Sz))), array('H', map(Map.block_code, blocks))
+
+def parse(mapdesc):
+    m = Map(mapdesc)
+    return (m.Nx, m.Ny, m.Nz, m.Sx, m.Sy, m.Sz), m.grid
+
+def timed(f, maps):
+    t = time.perf_counter()
+    for m in maps: f(m)
+    return time.perf_counter() - t
+
+def load_maps(directory):
+    maps = []
+    for f in sorted(Path(directory).glob('*.txt.gz')):
+        text = gzip.open(f, 'rt').read()
+        maps.append(text[:text.index('\n', text.index('START', text.index('ENDMAP')))+1])
+    return maps
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', nargs='?', default=Path(__file__).resolve().parent.parent / 'postmortem_static')
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    maps = load_maps(args.directory)
+    size = sum(map(len, maps))
+    print(f'{len(maps)} maps, {size/1e6:.1f} MB')
+    for name, f in (('regex', regex_parse), ('parser', parse)):
+        best = min(timed(f, maps) for _ in range(args.repeat))
+        print(f'{name:>8}: {best:.3f}s, {size/best/1e6:.1f} MB/s')
+    mismatches = sum(regex_parse(m) != parse(m) for m in maps)
+    print(f'{mismatches} mismatches')
@@ -34,8 +34,7 @@ def bruteforce_solve(m, stop_at_first=False, progress=False):
                     sys.stderr.flush()
                     sys.stderr.write('\b\b\b\b\b')
                 spincount += 1
-            for Ax, Ay, Az in itertools.product((-1, 0, 1), (-1, 0, 1), (-1, 0, 1)):
-                result = m.analyze_path_step(state, Ax, Ay, Az)
+            for (Ax, Ay, Az), result in m.successors(state):
                 if isinstance(result, Map.State):
                     nmoves = infos[state].moves + 1
                     if result in infos:
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import functools
 import http.server
 import os
 import re
@@ -40,6 +41,13 @@ def route_POST(pattern, fct):
 
 games = {}
 
+@functools.lru_cache(maxsize=16)
+def load_map(mapfile, mtime):
+    with open(mapsdir + '/' + mapfile, 'r') as f:
+        m = Map(f.read())
+    m.enable_transition_cache()
+    return m
+
 class Handler(http.server.SimpleHTTPRequestHandler):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=httpdir, **kwargs)
@@ -85,8 +93,7 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         self._send_text(text)
 
     def dyn_playing_api(self, mapfile, gameid):
-        with open(mapsdir + '/' + mapfile, 'r') as f:
-            m = Map(f.read())
+        m = load_map(mapfile, os.path.getmtime(mapsdir + '/' + mapfile))
         text = ""
         start = gameid not in games
         if start:
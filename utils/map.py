@@ -1,36 +1,54 @@
 #!/usr/bin/env python
 # -*- coding:utf8 -*-
 
+from array import array
 from collections import namedtuple
 from enum import Enum
+import functools
+import hashlib
 import itertools
 import math
+import operator
 import re
+import sys
+import time
 
 class Map:
 
     b64_digits = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
-    mapdesc_pattern = re.compile(r"^\n*MAP (\d+) (\d+) (\d+)\n+([a-zA-Z0-9+/\n\s]+)\n+ENDMAP\n+START (\d+) (\d+) (\d+)\n*$", re.MULTILINE)
+    b64_values = {c: i for i, c in enumerate(b64_digits)}
+    header_pattern = re.compile(r"\n*MAP (\d+) (\d+) (\d+)\n")
+    footer_pattern = re.compile(r"\nENDMAP\n+START (\d+) (\d+) (\d+)(?=\n|\Z)")
+    invalid_data_pattern = re.compile(r"[^a-zA-Z0-9+/\s]")
     pathdesc_pattern = re.compile(r"^ACC (-?\d+) (-?\d+) (-?\d+)$")
+    pathline_pattern = re.compile(r"[^\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]+") # Non empty lines, as str.splitlines splits them
     BlockType = Enum('BlockType', ['GOAL', 'ASTEROID', 'NEBULA', 'MAGCLOUD', 'CP1', 'CP2', 'CP3', 'CP4'])
     BlockInfo = namedtuple('BlockInfo', 'bt px py pz mx my mz empty'.split())
     State = namedtuple('State', 'Px Py Pz Vx Vy Vz checkpoint'.split())
     PathAnalysis = namedtuple('PathAnalysis', 'ok moves msg'.split())
+    time_budget_msg = "Analysis time budget exceeded"
+    outside_code = 0x1fff # Asteroid filling the whole cell, out of the universe
+    engine_version = 1 # To bump whenever the simulation of moves changes
+    accelerations = tuple((Ax, Ay, Az) for Ax in (-1, 0, 1) for Ay in (-1, 0, 1) for Az in (-1, 0, 1))
+    directions = tuple(d for d in accelerations if d != (0, 0, 0))
+    bits_table = bytes.maketrans(b'\x00\x01', b'01')
+    bytes_table = bytes.maketrans(b'01', b'\x00\x01')
 
     @classmethod
     def b64_itoa(cls, n):
         string = ''
         nb = math.floor(n)
         while nb > 0:
-            string = cls.b64_digits[nb % 64] + string
-            nb = math.floor(nb / 64)
+            nb, digit = divmod(nb, 64)
+            string = cls.b64_digits[digit] + string
         return string
 
     @classmethod
     def b64_atoi(cls, string):
         nb = 0
         for c in string:
-            nb = nb * 64 + cls.b64_digits.index(c)
+            if c not in cls.b64_values: raise ValueError(f"Invalid base 64 digit {c!r}")
+            nb = nb * 64 + cls.b64_values[c]
         return nb
 
     @classmethod
@@ -42,10 +60,18 @@ class Map:
             ((pz & 3) << 8) +\
             ((mz & 3) << 10) +\
             ((bt & 7) << 12)
-        return ('AAA' + cls.b64_itoa(nb))[-3:]
+        return cls.code_b64(nb)
 
     @classmethod
+    @functools.cache
+    def code_b64(cls, code):
+        """Return the 3 digits of a 15-bit code, shared by all callers."""
+        return ('AAA' + cls.b64_itoa(code))[-3:]
+
+    @classmethod
+    @functools.lru_cache(maxsize=1 << 16)
     def decode_block(cls, block):
+        """Return the BlockInfo of a block, shared by all blocks written the same."""
         nb = cls.b64_atoi(block)
         px = (nb & (3 << 0)) >> 0
         mx = (nb & (3 << 2)) >> 2
@@ -57,28 +83,99 @@ class Map:
         bte = cls.BlockType(bt+1)
         return cls.BlockInfo(bte, px, py, pz, mx, my, mz, block=='AAA')
 
+    @classmethod
+    @functools.lru_cache(maxsize=1 << 16)
+    def block_code(cls, block):
+        """Return the 15-bit code of a block, as stored in the compiled grid.
+        Blocks whose extra bits are set but whose fields are all zero are not
+        'AAA', they are stored as 0x8000 to keep them apart from empty blocks."""
+        nb = cls.b64_atoi(block)
+        return nb & 0x7fff or (0x8000 if nb else 0)
+
+    @classmethod
+    @functools.cache
+    def decode_code(cls, code):
+        """Return the BlockInfo of a code, shared by all cells of that code."""
+        return cls.BlockInfo(cls.BlockType(((code >> 12) & 7) + 1),
+                             code & 3, (code >> 4) & 3, (code >> 8) & 3,
+                             (code >> 2) & 3, (code >> 6) & 3, (code >> 10) & 3,
+                             code == 0)
+
     def __init__(self, mapdesc):
-        m = self.mapdesc_pattern.match(mapdesc)
         self.maxcp_cache = None
-        if m:
-            Nx, Ny, Nz, data, Sx, Sy, Sz = m.groups()
-            self.Nx, self.Ny, self.Nz, self.Sx, self.Sy, self.Sz = map(int, (Nx, Ny, Nz, Sx, Sy, Sz))
-            self.blocks = re.findall('...', ''.join(data.split()))
-        else:
-            self.Nx, self.Ny, self.Nz, self.Sx, self.Sy, self.Sz = [0]*6
-            self.blocks = []
+        self.occupancy_cache = None
+        self.blocked_bits_cache = None
+        self.clearance_cache = {}
+        self.envelope_cache = None
+        self.transition_cache = None
+        self.Nx, self.Ny, self.Nz, self.Sx, self.Sy, self.Sz = [0]*6
+        self.grid = array('H')
+        self.parse_error = self.parse(mapdesc)
+
+    def __getstate__(self):
+        """Leave the caches out when pickling, e.g. to hand the map over to
+        worker processes, they are built again there as needed."""
+        state = self.__dict__.copy()
+        state.update(maxcp_cache=None, occupancy_cache=None, blocked_bits_cache=None,
+                     clearance_cache={}, envelope_cache=None, transition_cache=None)
+        return state
+
+    @staticmethod
+    def position(text, i):
+        line, column = text.count('\n', 0, i) + 1, i - text.rfind('\n', 0, i)
+        return f"line {line}, column {column}"
+
+    def parse(self, mapdesc):
+        """Parse a map description, decoding its blocks straight into the
+        compiled grid. Return None, or a message locating the structure error.
+
+        The header is the first line, the footer is the last ENDMAP followed
+        by a START line (anything after it is ignored), and the blocks in
+        between are whitespace separated runs of base 64 digits, read three
+        digits at a time.
+        """
+        header = self.header_pattern.match(mapdesc)
+        if not header:
+            i = len(mapdesc) - len(mapdesc.lstrip('\n'))
+            return f"{self.position(mapdesc, i)}: expected 'MAP Nx Ny Nz'"
+        start = header.end()
+
+        invalid = self.invalid_data_pattern.search(mapdesc, start)
+        end = invalid.start() if invalid else len(mapdesc)
+        error = None
+        while True:
+            i = mapdesc.rfind('\nENDMAP', start + 1, end)
+            if i < 0:
+                if invalid:
+                    return f"{self.position(mapdesc, invalid.start())}: invalid character {invalid.group()!r}"
+                return error or "missing 'ENDMAP'"
+            footer = self.footer_pattern.match(mapdesc, i)
+            if footer: break
+            error = error or f"{self.position(mapdesc, i + 1)}: expected 'START Sx Sy Sz' after 'ENDMAP'"
+            end = i + 6
+
+        self.Nx, self.Ny, self.Nz = map(int, header.groups())
+        self.Sx, self.Sy, self.Sz = map(int, footer.groups())
+        blocks = mapdesc[start:i].split()
+        distinct = set(blocks)
+        if any(len(block) != 3 for block in distinct): # Blocks not separated by whitespace
+            blocks = re.findall('...', ''.join(blocks))
+            distinct = set(blocks)
+        codes = {block: self.block_code(block) for block in distinct}
+        self.grid = array('H', map(codes.__getitem__, blocks))
+        return None
 
     def __getitem__(self, t):
         x, y, z = t
         if x < 0 or x >= self.Nx or \
            y < 0 or y >= self.Ny or \
            z < 0 or z >= self.Nz:
-               return Map.BlockInfo(Map.BlockType.ASTEROID, 3, 3, 3, 3, 3, 3, False)
-        return self.decode_block(self.blocks[x + y * self.Nx + z * self.Nx * self.Ny])
+               return self.decode_code(self.outside_code)
+        return self.decode_code(self.grid[x + y * self.Nx + z * self.Nx * self.Ny])
 
     def __iter__(self):
-        for b in self.blocks:
-            yield self.decode_block(b)
+        for code in self.grid:
+            yield self.decode_code(code)
 
     @property
     def start(self):
@@ -88,18 +185,174 @@ class Map:
     def startstate(self):
         return Map.State(self.Sx, self.Sy, self.Sz, 0, 0, 0, 0)
 
+    def digest(self):
+        """Return a hash of the parsed map, the same whatever the spacing
+        and the encoding of the blocks of its description."""
+        grid = array('H', self.grid)
+        if sys.byteorder == 'big': grid.byteswap()
+        header = f"{self.Nx} {self.Ny} {self.Nz} {self.Sx} {self.Sy} {self.Sz}\n".encode()
+        return hashlib.sha256(header + grid.tobytes()).hexdigest()
+
     @property
     def maxcp(self):
         if self.maxcp_cache is None:
-            maxcp = 0
-            for b in self:
-                if b.bt == self.BlockType.CP1: maxcp = max(maxcp, 1)
-                elif b.bt == self.BlockType.CP2: maxcp = max(maxcp, 2)
-                elif b.bt == self.BlockType.CP3: maxcp = max(maxcp, 3)
-                elif b.bt == self.BlockType.CP4: maxcp = max(maxcp, 4)
-            self.maxcp_cache = maxcp
+            # CP1..CP4 are block types 4..7
+            self.maxcp_cache = max([((code >> 12) & 7) - 3 for code in set(self.grid)] + [0])
         return self.maxcp_cache
 
+    @property
+    def occupancy(self):
+        """Summed volume table of the non empty blocks: occupancy[i] with
+        i = x + y*(Nx+1) + z*(Nx+1)*(Ny+1) counts the blocks of the cells
+        before (x, y, z) on every axis."""
+        if self.occupancy_cache is None:
+            Nx, Ny, Nz, grid = self.Nx, self.Ny, self.Nz, self.grid
+            if len(grid) < Nx*Ny*Nz: # Invalid map, missing blocks are empty
+                grid = grid + array('H', bytes(2 * (Nx*Ny*Nz - len(grid))))
+            plane = [0] * ((Nx+1)*(Ny+1))
+            occupancy = array('l', plane)
+            for z in range(Nz):
+                row = [0] * (Nx+1)
+                rows = row.copy()
+                for y in range(Ny):
+                    cells = grid[(y + z*Ny)*Nx:(y + z*Ny + 1)*Nx]
+                    row = list(map(operator.add, row, [0, *itertools.accumulate(map(bool, cells))]))
+                    rows += row
+                plane = list(map(operator.add, plane, rows))
+                occupancy.extend(plane)
+            self.occupancy_cache = occupancy
+        return self.occupancy_cache
+
+    def occupied(self, x0, x1, y0, y1, z0, z1):
+        """Count the non empty blocks in the cells from (x0, y0, z0) to
+        (x1, y1, z1) included, all within the universe."""
+        o, sx, sy = self.occupancy, self.Nx+1, (self.Nx+1)*(self.Ny+1)
+        x1, y1, z1 = x1+1, (y1+1)*sx, (z1+1)*sy
+        y0, z0 = y0*sx, z0*sy
+        return o[x1+y1+z1] - o[x0+y1+z1] - o[x1+y0+z1] - o[x1+y1+z0] \
+             + o[x0+y0+z1] + o[x0+y1+z0] + o[x1+y0+z0] - o[x0+y0+z0]
+
+    @property
+    def blocked_bits(self):
+        """The universe padded with one layer of outside cells, as two big
+        integers whose bit x + y*(Nx+2) + z*(Nx+2)*(Ny+2) stands for the cell
+        (x-1, y-1, z-1): (blocked, inside), the first set for outside and non
+        empty cells, the second for cells within the universe."""
+        if self.blocked_bits_cache is None:
+            Nx, Ny, Nz, grid = self.Nx, self.Ny, self.Nz, self.grid
+            sx, sy = Nx+2, (Nx+2)*(Ny+2)
+            cells = bytes(map(bool, grid)).translate(self.bits_table).ljust(Nx*Ny*Nz, b'0')
+            pad = b'1' * (sx+1)
+            blocked = b'1'*sy + b''.join(
+                pad + b'11'.join(cells[(y + z*Ny)*Nx:(y + z*Ny + 1)*Nx] for y in range(Ny)) + pad
+                for z in range(Nz)) + b'1'*sy
+            inside = b'0'*sy + (b'0'*sx + (b'0' + b'1'*Nx + b'0')*Ny + b'0'*sx)*Nz + b'0'*sy
+            self.blocked_bits_cache = int(blocked[::-1], 2), int(inside[::-1], 2)
+        return self.blocked_bits_cache
+
+    def clearance_table(self, dx, dy, dz):
+        """Free runs along the direction (dx, dy, dz), computed once per map.
+
+        A step along a direction d from a cell c sweeps the cells c + e, where
+        each e_n is either 0 or d_n, and is free when none of them holds a
+        block or is out of the universe. The table holds a byte per cell of
+        the padded universe (see blocked_bits): the number of free steps in a
+        row from that cell.
+        """
+        if (dx, dy, dz) not in self.clearance_cache:
+            blocked, inside = self.blocked_bits
+            sx, sy = self.Nx+2, (self.Nx+2)*(self.Ny+2)
+            size = sy*(self.Nz+2)
+            delta = dx + dy*sx + dz*sy
+
+            def shift(bits, delta): # Cell c of the result is cell c + delta of bits
+                return bits >> delta if delta >= 0 else bits << -delta
+
+            step = 0
+            for ex in {0, dx}:
+                for ey in {0, dy}:
+                    for ez in {0, dz}:
+                        step |= shift(blocked, ex + ey*sx + ez*sy)
+            # Count the free steps in a row from each cell, bit-sliced: cells
+            # with n free steps or more are those with a free step whose next
+            # cell has n-1 of them, added to the 8 bit planes of the counts.
+            first = free = inside & ~step
+            planes = [0] * 8
+            for _ in range(255):
+                if not free: break
+                carry = free
+                for p in range(8):
+                    planes[p], carry = planes[p] ^ carry, planes[p] & carry
+                    if not carry: break
+                free = first & shift(free, delta)
+            table = sum(int.from_bytes(format(plane, f'0{size}b')[::-1].encode().translate(self.bytes_table), 'little') << p
+                        for p, plane in enumerate(planes) if plane)
+            self.clearance_cache[dx, dy, dz] = table.to_bytes(size, 'little')
+        return self.clearance_cache[dx, dy, dz]
+
+    @property
+    def envelope(self):
+        """Velocities a ship can still brake from, and the targets left to
+        touch, along each axis: a tuple (lo, hi, down, up) per axis.
+
+        A ship at P about to move at velocity V along an axis of N cells
+        stops at best at P + V*(V+1)/2 (braking from the next move on), so it
+        stays within the universe when lo[P] <= V <= hi[P], about sqrt(2*N)
+        at most. Otherwise it only goes one way until it leaves. up[k] is the
+        lowest top, in sixths of cell, of the blocks of the stages from k on
+        (checkpoints k+1 and up then the goal), and down[k] the highest
+        bottom: a ship going up from 6*P > up[k] misses some of them."""
+        if self.envelope_cache is None:
+            Nx, Ny, maxcp = self.Nx, self.Ny, self.maxcp
+            targets = {code for code in set(self.grid) if code and ((code >> 12) & 7 == 0 or (code >> 12) & 7 >= 4)}
+            stages = [[] for _ in range(maxcp + 1)]
+            for i, code in enumerate(self.grid):
+                if code in targets:
+                    bt = (code >> 12) & 7
+                    stages[maxcp if bt == 0 else bt - 4].append((i % Nx, i // Nx % Ny, i // (Nx*Ny), code))
+            envelope = []
+            for axis, N in enumerate((self.Nx, self.Ny, self.Nz)):
+                hi = array('l', [(math.isqrt(8*(N-1-P) + 1) - 1) // 2 for P in range(N)])
+                lo = array('l', [-v for v in reversed(hi)])
+                up, down = [math.inf] * (maxcp + 2), [-math.inf] * (maxcp + 2)
+                for k in range(maxcp, -1, -1):
+                    extents = [(6*cell[axis] - (((code >> 4*axis) & 15) >> 2), 6*cell[axis] + ((code >> 4*axis) & 3))
+                               for *cell, code in stages[k]]
+                    up[k] = min(up[k+1], max((top for bottom, top in extents), default=-math.inf))
+                    down[k] = max(down[k+1], min((bottom for bottom, top in extents), default=math.inf))
+                envelope.append((lo, hi, down[:-1], up[:-1]))
+            self.envelope_cache = envelope
+        return self.envelope_cache
+
+    def velocity_bounds(self, Px, Py, Pz, checkpoint):
+        """Return (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z): a ship at P can still
+        win only moving at a velocity within these bounds, as otherwise it
+        leaves the universe before touching the targets left along some axis
+        (see envelope)."""
+        bounds = []
+        for (lo, hi, down, up), P, N in zip(self.envelope, (Px, Py, Pz), (self.Nx, self.Ny, self.Nz)):
+            bounds.append(lo[P] if 6*P < down[checkpoint] else -N)
+            bounds.append(hi[P] if 6*P > up[checkpoint] else N)
+        return bounds
+
+    def doomed(self, Px, Py, Pz, Vx, Vy, Vz, checkpoint):
+        """Tell whether a ship at P about to move at velocity V can no longer
+        win, whatever it does (see velocity_bounds)."""
+        lx, hx, ly, hy, lz, hz = self.velocity_bounds(Px, Py, Pz, checkpoint)
+        return not (lx <= Vx <= hx and ly <= Vy <= hy and lz <= Vz <= hz)
+
+    def code_at(self, x, y, z):
+        """Return the code of the cell (x, y, z), outside_code out of the universe."""
+        if 0 <= x < self.Nx and 0 <= y < self.Ny and 0 <= z < self.Nz:
+            return self.grid[x + (y + z * self.Ny) * self.Nx]
+        return self.outside_code
+
+    def clearance(self, x, y, z, dx, dy, dz):
+        """Return how many whole steps along the direction (dx, dy, dz) can be
+        travelled from the cell (x, y, z) without meeting any block or
+        leaving the universe, up to 255."""
+        return self.clearance_table(dx, dy, dz)[(x+1) + (y+1 + (z+1) * (self.Ny+2)) * (self.Nx+2)]
+
     @property
     def valid(self):
         return not self.find_error()
@@ -117,7 +370,9 @@ class Map:
         - Invalid checkpoints
         """
 
-        if not self.blocks:
+        if self.parse_error:
+            return f"Invalid global structure ({self.parse_error})"
+        if not self.grid:
             return "Invalid global structure"
 
         if self.Nx < 0 or self.Nx > max_width or \
@@ -130,7 +385,7 @@ class Map:
            self.Sz < 0 or self.Sz >= self.Nz:
                return "Invalid start point"
 
-        if len(self.blocks) != self.Nx*self.Ny*self.Nz:
+        if len(self.grid) != self.Nx*self.Ny*self.Nz:
             return 'Wrong number of blocks'
 
         arrival = False
@@ -138,7 +393,8 @@ class Map:
         cp2 = False
         cp3 = False
         cp4 = False
-        for b in self:
+        for code in set(self.grid):
+            b = self.decode_code(code)
             if b.empty: continue
 
             if b.bt == Map.BlockType.GOAL: arrival = True
@@ -177,14 +433,32 @@ class Map:
     def check_path(self, pathdesc):
         return self.analyze_path(pathdesc).ok
 
-    def analyze_path(self, pathdesc):
+    @classmethod
+    def path_lines(cls, pathdesc):
+        """Iterate over the non empty lines of a path given as a string, or as
+        an iterable of lines such as a text file, without splitting it whole."""
+        if isinstance(pathdesc, str):
+            return (m.group() for m in cls.pathline_pattern.finditer(pathdesc))
+        return (p for lines in pathdesc for p in lines.splitlines() if p)
+
+    def analyze_path(self, pathdesc, max_moves=None, time_budget=None):
+        """Analyze a path one line at a time, only keeping the current state.
+        The analysis fails once the path goes over max_moves lines, or once it
+        has used time_budget seconds of CPU time of the calling thread, when
+        they are given, so that other threads of a server don't count."""
         moves = 0
         victory = False
         state = self.startstate
+        if time_budget is not None:
+            deadline = time.thread_time() + time_budget
 
-        for p in filter(None, pathdesc.splitlines()):
+        for n, p in enumerate(self.path_lines(pathdesc)):
             if victory:
                 return self.PathAnalysis(False, moves, "Moves after destination")
+            if max_moves is not None and n >= max_moves:
+                return self.PathAnalysis(False, moves, "Too many moves")
+            if time_budget is not None and time.thread_time() >= deadline:
+                return self.PathAnalysis(False, moves, self.time_budget_msg)
 
             m = self.pathdesc_pattern.match(p)
             if not m: return self.PathAnalysis(False, moves, "Invalid line syntax")
@@ -207,7 +481,18 @@ class Map:
             return self.PathAnalysis(True, moves, "Victory")
         return self.PathAnalysis(False, moves, "Mission not completed")
 
+    def enable_transition_cache(self, maxsize=65536):
+        """Memoize analyze_path_step on this map, keeping the maxsize most
+        recently used (state, acceleration) transitions.
+        Hits and misses are reported by self.transition_cache.cache_info()."""
+        self.transition_cache = functools.lru_cache(maxsize)(self.compute_path_step)
+
     def analyze_path_step(self, state, Ax, Ay, Az):
+        if self.transition_cache:
+            return self.transition_cache(tuple(state), Ax, Ay, Az)
+        return self.compute_path_step(state, Ax, Ay, Az)
+
+    def compute_path_step(self, state, Ax, Ay, Az):
         if Ax not in (-1, 0, 1) or \
            Ay not in (-1, 0, 1) or \
            Az not in (-1, 0, 1):
@@ -226,51 +511,225 @@ class Map:
                (abs(nVz) > 1 and abs(nVz) >= abs(Vz)):
                 return self.PathAnalysis(False, 0, "Invalid acceleration in nebula")
 
-        Vx, Vy, Vz = Vx+Ax, Vy+Ay, Vz+Az
-
-        eps = 0.0001
-        intersections = []
-        blocks_precedence = [5, 0, 6, 7, 1, 2, 3, 4]
-        for Vn in (Vx, Vy, Vz):
-            if Vn:
-                for i in range(6*abs(Vn)+1):
-                    t = i / abs(Vn) / 6;
-                    Ix, Iy, Iz = Px + t * Vx, Py + t * Vy, Pz + t * Vz
-                    bxs = [round(Ix)] if abs((Ix % 1) - 0.5) > 0.1 else [math.floor(Ix), math.ceil(Ix)]
-                    bys = [round(Iy)] if abs((Iy % 1) - 0.5) > 0.1 else [math.floor(Iy), math.ceil(Iy)]
-                    bzs = [round(Iz)] if abs((Iz % 1) - 0.5) > 0.1 else [math.floor(Iz), math.ceil(Iz)]
-                    for Bx, By, Bz in itertools.product(bxs, bys, bzs):
-                        b = self[Bx, By, Bz]
-                        if b.empty: continue
-                        if Bx - b.mx/6 - eps <= Ix and Ix <= Bx + b.px/6 + eps and \
-                           By - b.my/6 - eps <= Iy and Iy <= By + b.py/6 + eps and \
-                           Bz - b.mz/6 - eps <= Iz and Iz <= Bz + b.pz/6 + eps:
-                               intersections.append((t, blocks_precedence[b.bt.value-1], b))
-
-        Px, Py, Pz = Px+Vx, Py+Vy, Pz+Vz
+        return self.move(Px, Py, Pz, Vx+Ax, Vy+Ay, Vz+Az, checkpoint)
 
-        for submoves, _, bc in sorted(intersections):
-            if bc.bt == self.BlockType.GOAL:
-                if not bc.empty:
-                    if checkpoint == self.maxcp:
-                        return self.PathAnalysis(True, submoves, "Victory")
-            elif bc.bt == self.BlockType.ASTEROID:
+    def successors(self, state, prune=False):
+        """Evaluate every legal acceleration from a state at once.
+        Return a list of ((Ax, Ay, Az), result) where result is, as for
+        analyze_path_step, the new State or a final PathAnalysis. With
+        prune, the accelerations that leave the ship doomed are left out,
+        without sweeping their moves."""
+        Px, Py, Pz, Vx, Vy, Vz, checkpoint = state
+        bt = self[Px, Py, Pz].bt
+        if bt == self.BlockType.MAGCLOUD:
+            if prune and self.doomed(Px, Py, Pz, Vx, Vy, Vz, checkpoint): return []
+            return [((0, 0, 0), self.move(Px, Py, Pz, Vx, Vy, Vz, checkpoint))]
+        nebula = bt == self.BlockType.NEBULA
+        if prune:
+            lx, hx, ly, hy, lz, hz = self.velocity_bounds(Px, Py, Pz, checkpoint)
+            # Moves stay within the universe, so that no velocity is past N
+            prune = (lx, hx, ly, hy, lz, hz) != (-self.Nx, self.Nx, -self.Ny, self.Ny, -self.Nz, self.Nz)
+        results = []
+        for Ax, Ay, Az in self.accelerations:
+            nVx, nVy, nVz = Vx+Ax, Vy+Ay, Vz+Az
+            if nebula and \
+               ((abs(nVx) > 1 and abs(nVx) >= abs(Vx)) or \
+                (abs(nVy) > 1 and abs(nVy) >= abs(Vy)) or \
+                (abs(nVz) > 1 and abs(nVz) >= abs(Vz))):
+                continue
+            if prune and not (lx <= nVx <= hx and ly <= nVy <= hy and lz <= nVz <= hz):
+                continue
+            results.append(((Ax, Ay, Az), self.move(Px, Py, Pz, nVx, nVy, nVz, checkpoint)))
+        return results
+
+    def move(self, Px, Py, Pz, Vx, Vy, Vz, checkpoint):
+        """Move from P at the (already accelerated) velocity V."""
+        if not (Vx or Vy or Vz):
+            return Map.State(Px, Py, Pz, Vx, Vy, Vz, checkpoint)
+
+        # Fast path when the cells the move can reach hold no block
+        Nx, Ny, Nz = self.Nx, self.Ny, self.Nz
+        x0, x1 = (Px, Px+Vx) if Vx >= 0 else (Px+Vx, Px)
+        y0, y1 = (Py, Py+Vy) if Vy >= 0 else (Py+Vy, Py)
+        z0, z1 = (Pz, Pz+Vz) if Vz >= 0 else (Pz+Vz, Pz)
+        inside = x0 >= 0 and x1 < Nx and y0 >= 0 and y1 < Ny and z0 >= 0 and z1 < Nz
+        if inside:
+            if not self.occupied(x0, x1, y0, y1, z0, z1):
+                return Map.State(Px+Vx, Py+Vy, Pz+Vz, Vx, Vy, Vz, checkpoint)
+        elif not self.occupied(max(x0, 0), min(x1, Nx-1), max(y0, 0), min(y1, Ny-1), max(z0, 0), min(z1, Nz-1)):
+            return self.PathAnalysis(False, self.exit_time(Px, Py, Pz, Vx, Vy, Vz), "Out of the universe")
+
+        # Straight and diagonal moves are a run of whole steps along a
+        # direction: the clearance tells how many of them are free, and a
+        # step into a cell filled with asteroid crashes halfway through.
+        k = max(abs(Vx), abs(Vy), abs(Vz))
+        if Vx in (0, k, -k) and Vy in (0, k, -k) and Vz in (0, k, -k) and \
+           0 <= Px < Nx and 0 <= Py < Ny and 0 <= Pz < Nz:
+            dx, dy, dz = Vx // k, Vy // k, Vz // k
+            j = self.clearance(Px, Py, Pz, dx, dy, dz)
+            if j >= k:
+                return Map.State(Px+Vx, Py+Vy, Pz+Vz, Vx, Vy, Vz, checkpoint)
+            Cx, Cy, Cz = Px + j*dx, Py + j*dy, Pz + j*dz
+            if self.code_at(Cx, Cy, Cz) == 0 and any(
+                    self.code_at(Cx+ex, Cy+ey, Cz+ez) == self.outside_code
+                    for ex in {0, dx} for ey in {0, dy} for ez in {0, dz}):
                 msg = "Collision"
-                for Pn, Vn, Nn in ((Px, Vx, self.Nx), (Py, Vy, self.Ny), (Pz, Vz, self.Nz)):
-                    In = Pn - (1-t) * Vn
-                    if In < 0 or In >= Nn: msg = "Out of the universe"
-                return self.PathAnalysis(False, submoves, msg)
-            elif bc.bt == self.BlockType.CP1:
-                if checkpoint == 0: checkpoint += 1
-            elif bc.bt == self.BlockType.CP2:
-                if checkpoint == 1: checkpoint += 1
-            elif bc.bt == self.BlockType.CP3:
-                if checkpoint == 2: checkpoint += 1
-            elif bc.bt == self.BlockType.CP4:
-                if checkpoint == 3: checkpoint += 1
+                for Pn, Nn in ((Px+Vx, Nx), (Py+Vy, Ny), (Pz+Vz, Nz)):
+                    if Pn < 0 or Pn >= Nn: msg = "Out of the universe"
+                return self.PathAnalysis(False, (6*j+3) / k / 6, msg)
+
+        L, hits, collision = self.sweep(Px, Py, Pz, Vx, Vy, Vz)
+        Px, Py, Pz = Px+Vx, Py+Vy, Pz+Vz
+        if not hits:
+            return Map.State(Px, Py, Pz, Vx, Vy, Vz, checkpoint)
+
+        # At a given time, asteroids are hit first, then checkpoints in
+        # order, then the goal. A block spanning several sample times is
+        # hit at the first of them where it can still have an effect.
+        u = 0
+        while checkpoint < self.maxcp:
+            u = min((max(first, u) for first, last, code in hits
+                     if (code >> 12) & 7 == checkpoint + 4 and last >= u), default=None)
+            if u is None or (collision is not None and u >= collision): break
+            checkpoint += 1
+        if checkpoint == self.maxcp:
+            u = min((max(first, u) for first, last, code in hits
+                     if (code >> 12) & 7 == 0 and last >= u), default=None)
+            if u is not None and (collision is None or u < collision):
+                return self.PathAnalysis(True, self.sweep_time(u, L, Vx, Vy, Vz), "Victory")
+        if collision is not None:
+            msg = "Collision"
+            for Pn, Nn in ((Px, self.Nx), (Py, self.Ny), (Pz, self.Nz)):
+                if Pn < 0 or Pn >= Nn: msg = "Out of the universe"
+            return self.PathAnalysis(False, self.sweep_time(collision, L, Vx, Vy, Vz), msg)
 
         return Map.State(Px, Py, Pz, Vx, Vy, Vz, checkpoint)
 
+    @staticmethod
+    def sweep_interval(Pn, Vn, L, lo, hi):
+        """Return the (first, last) integer times at which the coordinate
+        Pn + Vn*u/6L lies between lo/6 and hi/6, first > last if it never does."""
+        a = (lo - 6*Pn) * L
+        b = (hi - 6*Pn) * L
+        if Vn > 0: return -(-a // Vn), b // Vn
+        if Vn < 0: return -(-b // Vn), a // Vn
+        return (0, 6*L) if a <= 0 <= b else (1, 0)
+
+    @staticmethod
+    def sweep_cells(Pn, Vn, L, first, last):
+        """Return the cells whose whole volume the coordinate Pn + Vn*u/6L
+        reaches for some time u between first and last."""
+        a, b = sorted((6*Pn*L + Vn*first, 6*Pn*L + Vn*last))
+        return range(-(-(a - 3*L) // (6*L)), (b + 3*L) // (6*L) + 1)
+
+    @staticmethod
+    def sweep_time(u, L, *V):
+        """Convert an integer sweep time to the fraction of move it stands for."""
+        for Vn in V:
+            if Vn and u % (L // abs(Vn)) == 0:
+                return u // (L // abs(Vn)) / abs(Vn) / 6
+
+    def exit_time(self, Px, Py, Pz, Vx, Vy, Vz):
+        """Return the first sample time of a move ending out of the universe
+        that is half a cell away from it or more, entering an outside cell."""
+        L = math.lcm(*(abs(Vn) for Vn in (Vx, Vy, Vz) if Vn))
+        u = 6*L
+        for Pn, Vn, Nn in ((Px, Vx, self.Nx), (Py, Vy, self.Ny), (Pz, Vz, self.Nz)):
+            if Pn + Vn >= Nn:
+                u = min(u, self.sweep_interval(Pn, Vn, L, 6*Nn-3, 6*(Pn+Vn))[0])
+            elif Pn + Vn < 0:
+                u = min(u, self.sweep_interval(Pn, Vn, L, 6*(Pn+Vn), -3)[0])
+        u = min(-(-u // (L // abs(Vn))) * (L // abs(Vn)) for Vn in (Vx, Vy, Vz) if Vn)
+        return self.sweep_time(u, L, Vx, Vy, Vz)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def sweep_pattern(Vx, Vy, Vz):
+        """Cells met by a move at velocity V, relative to its start cell.
+
+        A move is sampled 6*|Vn|+1 times along each moving axis n. With L the
+        least common multiple of the non-zero speeds, every sample falls on an
+        integer time u between 0 and 6L: sample i of axis n is u = i*L/|Vn|.
+        None of this depends on the map or on the start position, so the
+        pattern is computed once per velocity and shared by all maps.
+
+        Return (L, cells), where cells lists (enter, dx, dy, dz, xt, yt, zt)
+        in the order the move enters them. xt[code & 15] is the (first, last)
+        samples inside a block of that code along x, yt[(code >> 4) & 15] and
+        zt[(code >> 8) & 15] likewise along y and z. As the first sample after
+        a time only grows with it, the first sample inside the block is the
+        latest of the three firsts, and the last sample the earliest of the
+        three lasts.
+        """
+        interval, cells = Map.sweep_interval, Map.sweep_cells
+        L = math.lcm(*(abs(Vn) for Vn in (Vx, Vy, Vz) if Vn))
+        samples = sorted({u for Vn in (Vx, Vy, Vz) if Vn for u in range(0, 6*L+1, L // abs(Vn))})
+        nxt, prv = [0] * (6*L+1), [0] * (6*L+1)
+        for a, b in zip(samples, samples[1:]):
+            nxt[a+1:b+1] = [b] * (b-a)
+            prv[a:b] = [a] * (b-a)
+        prv[6*L] = 6*L
+
+        @functools.cache
+        def extents(Vn, dn):
+            table = []
+            for e in range(16):
+                first, last = interval(0, Vn, L, 6*dn - (e >> 2), 6*dn + (e & 3))
+                if first <= 6*L and last >= 0:
+                    first, last = nxt[max(first, 0)], prv[min(last, 6*L)]
+                table.append((first, last) if 0 <= first <= last <= 6*L else (6*L+1, -1))
+            return tuple(table)
+
+        pattern = []
+        for dx in range(min(0, Vx), max(0, Vx)+1):
+            xf, xl = interval(0, Vx, L, 6*dx-3, 6*dx+3)
+            xf, xl = max(xf, 0), min(xl, 6*L)
+            if xf > xl: continue
+            for dy in cells(0, Vy, L, xf, xl):
+                yf, yl = interval(0, Vy, L, 6*dy-3, 6*dy+3)
+                yf, yl = max(yf, xf), min(yl, xl)
+                if yf > yl: continue
+                for dz in cells(0, Vz, L, yf, yl):
+                    zf, zl = interval(0, Vz, L, 6*dz-3, 6*dz+3)
+                    if max(zf, yf) > min(zl, yl): continue
+                    pattern.append((max(zf, yf), dx, dy, dz, extents(Vx, dx), extents(Vy, dy), extents(Vz, dz)))
+        pattern.sort(key=lambda cell: cell[0])
+        return L, tuple(pattern)
+
+    def sweep(self, Px, Py, Pz, Vx, Vy, Vz):
+        """Find the blocks met by a move, using exact integer arithmetic.
+
+        Every cell reachable by the move is visited once, in the order the
+        move enters them, and for each non empty block the first and last
+        sample times inside the block are looked up. Cells entered after an
+        asteroid has been hit are not visited.
+
+        Return L, the list of (first, last, code) hits (see sweep_pattern)
+        and the time of the first asteroid hit, None if there is none.
+        """
+        L, pattern = self.sweep_pattern(Vx, Vy, Vz)
+        Nx, Ny, Nz, grid = self.Nx, self.Ny, self.Nz, self.grid
+        inside = 0 <= min(Px, Px+Vx) and max(Px, Px+Vx) < Nx and \
+                 0 <= min(Py, Py+Vy) and max(Py, Py+Vy) < Ny and \
+                 0 <= min(Pz, Pz+Vz) and max(Pz, Pz+Vz) < Nz
+        hits = []
+        collision = 6*L+1
+        for enter, dx, dy, dz, xt, yt, zt in pattern:
+            if enter > collision: break
+            Bx, By, Bz = Px+dx, Py+dy, Pz+dz
+            if inside or (0 <= Bx < Nx and 0 <= By < Ny and 0 <= Bz < Nz):
+                code = grid[Bx + By * Nx + Bz * Nx * Ny]
+                if not code: continue
+            else:
+                code = self.outside_code
+            xf, xl = xt[code & 15]
+            yf, yl = yt[(code >> 4) & 15]
+            zf, zl = zt[(code >> 8) & 15]
+            lo, hi = max(xf, yf, zf), min(xl, yl, zl)
+            if lo > hi: continue
+            hits.append((lo, hi, code))
+            if (code >> 12) & 7 == 1: collision = min(collision, lo)
+        return L, hits, collision if collision <= 6*L else None
 
 if __name__ == '__main__':
     import sys